@@ -0,0 +1,166 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Packed archive of entity XML, for bulk snapshots.
+
+An archive is a pair of append-only files: PATH.data holds the XML blobs of
+the entities, compressed with zlib by default, one after the other, and
+PATH.index holds one record per blob, with its key, offset and length.
+Both are memory-mapped by ArchiveReader, which only parses the index when
+opened; the blobs are read from the mapping when needed:
+
+    with ArchiveWriter("project.pack") as writer:
+        writer.add(lims.get_artifacts(projectname="P1", resolve=True))
+
+    lims = Lims(BASEURI, USERNAME, PASSWORD,
+                backing_store=ArchiveReader("project.pack"))
+
+The entities found in the backing store of a Lims are then loaded from it
+instead of the LIMS. Writing an entity again appends a new blob, which
+replaces the previous one for readers opened afterwards.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import zlib
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+# Index record header: offset and length of the blob, flags, key length;
+# followed by the UTF-8 key
+RECORD = struct.Struct("<QIBH")
+COMPRESSED = 1
+
+
+def entity_key(entity):
+    "Return the archive key of an entity: its endpoint and LIMS id."
+    return f"{entity._URI}/{entity.id}"
+
+
+class ArchiveWriter:
+    """Appends the XML of entities to an archive, creating it if needed.
+    Use it as a context manager, or call close() when done."""
+
+    def __init__(self, path, compress=True, level=6):
+        self.path = path
+        self.compress = compress
+        self.level = level
+        self._data = open(path + ".data", "ab")
+        self._index = open(path + ".index", "ab")
+        self._offset = self._data.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def write(self, key, xml):
+        "Append the XML blob, as bytes, under the key."
+        flags = 0
+        if self.compress:
+            xml = zlib.compress(xml, self.level)
+            flags |= COMPRESSED
+        self._data.write(xml)
+        key = key.encode("utf-8")
+        self._index.write(RECORD.pack(self._offset, len(xml), flags, len(key)) + key)
+        self._offset += len(xml)
+
+    def add(self, entities):
+        "Append the XML of loaded entities; return the number written."
+        count = 0
+        for entity in entities:
+            self.write(entity_key(entity), entity.xml())
+            count += 1
+        return count
+
+
+class ArchiveReader:
+    """Read-only access to an archive, usable as the backing_store of a Lims.
+    Records cut short by an interrupted append are ignored, with a warning.
+
+    entries: key -> (offset, length, flags) of the last blob written for it
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        self._data = self._map(path + ".data")
+        index = self._map(path + ".index")
+        position = 0
+        while position < len(index):
+            if position + RECORD.size > len(index):
+                break
+            offset, length, flags, key_length = RECORD.unpack_from(index, position)
+            end = position + RECORD.size + key_length
+            if end > len(index):
+                break
+            key = bytes(index[position + RECORD.size : end]).decode("utf-8")
+            position = end
+            if offset + length > len(self._data):
+                logger.warning(f"Ignoring {key} in {path}, its blob is cut short")
+                continue
+            self.entries[key] = (offset, length, flags)
+        if position < len(index):
+            # Left by an append interrupted by a crash
+            logger.warning(
+                f"Ignoring the partial record at the end of {path}.index,"
+                f" {len(index) - position} bytes"
+            )
+        if isinstance(index, mmap.mmap):
+            index.close()
+
+    @staticmethod
+    def _map(path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files cannot be mapped
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        return self.entries.keys()
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def _blob(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, 0
+        offset, length, flags = entry
+        return memoryview(self._data)[offset : offset + length], flags
+
+    def get(self, key):
+        "Return the XML blob stored under the key, as bytes, or None."
+        blob, flags = self._blob(key)
+        if blob is None:
+            return None
+        with blob:
+            if flags & COMPRESSED:
+                return zlib.decompress(blob)
+            return bytes(blob)
+
+    def load(self, entity):
+        """Return the XML root of the entity if archived, else None.
+        Uncompressed blobs are parsed straight from the mapping."""
+        blob, flags = self._blob(entity_key(entity))
+        if blob is None:
+            return None
+        with blob:
+            parser = ElementTree.XMLParser()
+            parser.feed(zlib.decompress(blob) if flags & COMPRESSED else blob)
+            return parser.close()
@@ -0,0 +1,359 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Resumable crawl of the projects of the LIMS.
+
+ProjectCrawler walks projects -> samples -> artifacts -> processes -> files,
+loading each level in bulk and handing the entities to a visitor. The
+projects to crawl are kept in a SQLite work queue, where the last completed
+stage of each project is checkpointed, so that a crawl stopped by a crash
+resumes where it was:
+
+    crawler = ProjectCrawler(lims, "crawl.sqlite", visit=mirror_visitor)
+    crawler.seed()  # the open projects; does nothing for queued ones
+    crawler.run()
+
+Projects are crawled by a pool of worker threads. Several processes may run
+the same crawl by sharing the queue file: each claims its projects for a
+lease period, renewed at each checkpoint and periodically while they are
+crawled, after which the projects of a worker that died are claimed again
+by others. A worker whose lease was lost, and its project claimed by
+another, stops crawling it without recording anything.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from genologics.entities import Project
+from genologics.lims import MAX_WORKERS, _raise_first
+
+logger = logging.getLogger(__name__)
+
+# Stages of the default traversal plan, in the order they are crawled
+STAGES = ("samples", "artifacts", "processes", "files")
+
+# Seconds after which a project claimed by a worker without checkpointing
+# is considered abandoned
+LEASE = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id TEXT PRIMARY KEY, state TEXT, stage INTEGER, worker TEXT,
+    claimed REAL, attempts INTEGER, error TEXT);
+CREATE INDEX IF NOT EXISTS units_state ON units (state);
+"""
+
+
+class LeaseLost(RuntimeError):
+    "Raised if a worker no longer holds the unit it is crawling."
+
+    pass
+
+
+class WorkQueue:
+    """Queue of the projects to crawl, in a SQLite database file.
+
+    Each unit is in the state pending, running, done or failed, and records
+    the number of stages of the plan completed for it. The updates of a
+    running unit are only done for the worker holding it, and return
+    whether it did.
+    """
+
+    def __init__(self, path, lease=LEASE):
+        self.path = path
+        self.lease = lease
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        # A connection per call, so that threads and processes can share the
+        # queue; transactions are started explicitly
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return _Closing(connection)
+
+    def add(self, ids):
+        "Queue the units not queued yet; return the number added."
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO units VALUES (?, 'pending', 0, NULL, NULL, 0, NULL)",
+                [(id,) for id in ids],
+            )
+            added = connection.total_changes - before
+            connection.execute("COMMIT")
+        return added
+
+    def claim(self, worker):
+        """Claim the next pending unit, or one whose lease has expired.
+        Return its id and number of completed stages, or None."""
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT id, stage FROM units WHERE state = 'pending'"
+                " OR (state = 'running' AND claimed < ?) ORDER BY rowid LIMIT 1",
+                (now - self.lease,),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE units SET state = 'running', worker = ?, claimed = ?,"
+                    " attempts = attempts + 1 WHERE id = ?",
+                    (worker, now, row[0]),
+                )
+            connection.execute("COMMIT")
+        return row
+
+    def renew(self, id, worker):
+        "Renew the lease of the worker on the unit."
+        return self._update(id, worker, "claimed = ?", (time.time(),))
+
+    def checkpoint(self, id, worker, stage):
+        "Record the number of completed stages, renewing the lease."
+        return self._update(id, worker, "stage = ?, claimed = ?", (stage, time.time()))
+
+    def complete(self, id, worker):
+        return self._update(id, worker, "state = 'done', error = NULL", ())
+
+    def fail(self, id, worker, error, max_attempts):
+        "Requeue the unit, or mark it failed after max_attempts claims."
+        return self._update(
+            id,
+            worker,
+            "state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,"
+            " error = ?",
+            (max_attempts, error),
+        )
+
+    def _update(self, id, worker, assignments, params):
+        with self._connect() as connection:
+            cursor = connection.execute(
+                f"UPDATE units SET {assignments}"
+                " WHERE id = ? AND worker = ? AND state = 'running'",
+                (*params, id, worker),
+            )
+            return cursor.rowcount > 0
+
+    def release(self):
+        """Requeue the running units, after all workers died; otherwise
+        they are only claimed again once their lease has expired."""
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE units SET state = 'pending' WHERE state = 'running'"
+            )
+
+    def retry_failed(self):
+        "Requeue the failed units, resetting their attempts."
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE units SET state = 'pending', attempts = 0"
+                " WHERE state = 'failed'"
+            )
+
+    def progress(self):
+        "Return a dictionary of state -> number of units."
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT state, count(*) FROM units GROUP BY state"
+            ).fetchall()
+        progress = dict(pending=0, running=0, done=0, failed=0)
+        progress.update(rows)
+        return progress
+
+    def errors(self):
+        "Return a dictionary of the failed unit ids -> their last error."
+        with self._connect() as connection:
+            return dict(
+                connection.execute(
+                    "SELECT id, error FROM units WHERE state = 'failed'"
+                ).fetchall()
+            )
+
+
+class _Closing:
+    "Context manager closing a SQLite connection, which sqlite3 does not do."
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.connection.in_transaction:
+            self.connection.execute("ROLLBACK")
+        self.connection.close()
+
+
+class ProjectCrawler:
+    """Crawls projects with a pool of worker threads, stage by stage.
+
+    queue_path: SQLite file of the work queue, shared by the processes
+                running the same crawl.
+    plan: stages to crawl for each project, a subsequence of STAGES.
+          Stages needed by a later one but not in the plan are only listed,
+          not loaded or visited.
+    visit: optional function called with (project, stage, entities) once
+           the entities of a stage are loaded, before it is checkpointed.
+           It must be thread-safe when workers > 1.
+    workers: number of projects crawled concurrently.
+    max_workers: number of concurrent requests when loading a stage.
+    max_attempts: number of times a failing project is tried.
+    """
+
+    def __init__(
+        self,
+        lims,
+        queue_path,
+        plan=STAGES,
+        visit=None,
+        workers=4,
+        max_workers=MAX_WORKERS,
+        max_attempts=3,
+        lease=LEASE,
+    ):
+        unknown = [stage for stage in plan if stage not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown crawl stages: {unknown}")
+        self.lims = lims
+        self.queue = WorkQueue(queue_path, lease=lease)
+        self.plan = sorted(plan, key=STAGES.index)
+        self.visit = visit
+        self.workers = workers
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.entity_count = 0
+        self._lock = threading.Lock()
+        self._started = None
+        # Unit id -> worker, of the units being crawled, see _renew_leases()
+        self._held = dict()
+
+    def seed(self, projects=None, open_only=True):
+        """Queue the given projects, by default all those of the LIMS,
+        only the open ones unless open_only is False. Projects already
+        queued keep their progress. Return the number of projects added."""
+        if projects is None:
+            projects = self.lims.get_projects()
+            if open_only:
+                _raise_first(self.lims._load_entities(projects, self.max_workers))
+                projects = [p for p in projects if p.close_date is None]
+        return self.queue.add(project.id for project in projects)
+
+    def run(self):
+        """Crawl the queued projects until none is left to claim.
+        Return the progress of the queue."""
+        self._started = time.monotonic()
+        self.entity_count = 0
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_leases, args=(stop,))
+        heartbeat.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self._work) for _ in range(self.workers)]
+                for future in futures:
+                    future.result()
+        finally:
+            stop.set()
+            heartbeat.join()
+        return self.queue.progress()
+
+    def _renew_leases(self, stop):
+        "Renew the leases of the units being crawled until stop is set."
+        while not stop.wait(self.queue.lease / 3):
+            with self._lock:
+                held = list(self._held.items())
+            for id, worker in held:
+                if not self.queue.renew(id, worker):
+                    logger.warning(f"Lease of project {id} lost by {worker}")
+
+    def _work(self):
+        worker = f"{os.getpid()}-{threading.get_ident()}"
+        while True:
+            unit = self.queue.claim(worker)
+            if unit is None:
+                return
+            id, stage = unit
+            with self._lock:
+                self._held[id] = worker
+            try:
+                self.crawl(Project(self.lims, id=id), stage, worker)
+            except LeaseLost as e:
+                logger.warning(str(e))
+            except Exception as e:
+                logger.warning(f"Crawl of project {id} failed: {e!r}")
+                self.queue.fail(id, worker, repr(e), self.max_attempts)
+            else:
+                self.queue.complete(id, worker)
+            finally:
+                with self._lock:
+                    self._held.pop(id, None)
+            self._report()
+
+    def crawl(self, project, completed=0, worker=None):
+        """Crawl the stages of the plan for the project, skipping the first
+        completed ones. If the project was claimed in the queue by worker,
+        each stage is checkpointed, and LeaseLost is raised if the worker
+        no longer holds it."""
+        listed = dict()
+        for position, stage in enumerate(self.plan):
+            if position < completed:
+                continue
+            entities = self._list(project, stage, listed)
+            _raise_first(self.lims._load_entities(entities, self.max_workers))
+            if self.visit is not None:
+                self.visit(project, stage, entities)
+            if worker is not None and not self.queue.checkpoint(
+                project.id, worker, position + 1
+            ):
+                raise LeaseLost(f"Project {project.id} is no longer held by {worker}")
+            with self._lock:
+                self.entity_count += len(entities)
+
+    def _list(self, project, stage, listed):
+        "Return the entities of the stage for the project, listing them once."
+        if stage in listed:
+            return listed[stage]
+        if stage == "samples":
+            entities = self.lims.get_samples(projectlimsid=project.id)
+        elif stage == "artifacts":
+            samples = self._list(project, "samples", listed)
+            entities = []
+            if samples:
+                entities = self.lims.get_artifacts(
+                    samplelimsid=[sample.id for sample in samples]
+                )
+        elif stage == "processes":
+            artifacts = self._list(project, "artifacts", listed)
+            entities = []
+            if artifacts:
+                entities = self.lims.get_processes(
+                    inputartifactlimsid=[artifact.id for artifact in artifacts]
+                )
+        else:
+            # Files are linked from the XML of artifacts, and of processes
+            # if they are crawled, which must then be loaded
+            parents = list(self._list(project, "artifacts", listed))
+            if "processes" in self.plan:
+                parents.extend(self._list(project, "processes", listed))
+            _raise_first(self.lims._load_entities(parents, self.max_workers))
+            files = dict()
+            for parent in parents:
+                files.update(dict.fromkeys(parent.files))
+            entities = list(files)
+        listed[stage] = entities
+        return entities
+
+    def _report(self):
+        progress = self.queue.progress()
+        elapsed = time.monotonic() - self._started
+        with self._lock:
+            count = self.entity_count
+        rate = count / elapsed if elapsed else 0.0
+        total = sum(progress.values())
+        logger.info(
+            f"Crawled {progress['done']}/{total} projects"
+            f" ({progress['failed']} failed): {count} entities, {rate:.1f}/s"
+        )
@@ -8,8 +8,10 @@ Copyright (C) 2012 Per Kraulis
 
 import datetime
 import logging
+import sys
 import time
 from decimal import Decimal
+from urllib.parse import parse_qs, urlparse
 from xml.etree import ElementTree
 
 import six
@@ -19,6 +21,14 @@ from genologics.constants import nsmap
 logger = logging.getLogger(__name__)
 
 
+def snapshot(instance):
+    """Record the unmodified XML of the instance before a change,
+    so that Entity.put() can tell whether anything changed."""
+    take_snapshot = getattr(instance, "_snapshot", None)
+    if take_snapshot is not None:
+        take_snapshot()
+
+
 class BaseDescriptor:
     "Abstract base descriptor for an instance attribute."
 
@@ -40,6 +50,14 @@ class TagDescriptor(BaseDescriptor):
         else:
             return instance.root
 
+    def get_summary(self, instance):
+        """Return the node describing the instance in a list query,
+        if the instance has not been loaded yet, else None.
+        """
+        if self.tag and instance.root is None:
+            return getattr(instance, "_summary", None)
+        return None
+
 
 class StringDescriptor(TagDescriptor):
     """An instance attribute containing a string value
@@ -47,6 +65,11 @@ class StringDescriptor(TagDescriptor):
     """
 
     def __get__(self, instance, cls):
+        summary = self.get_summary(instance)
+        if summary is not None:
+            node = summary.find(self.tag)
+            if node is not None:
+                return node.text
         instance.get()
         node = self.get_node(instance)
         if node is None:
@@ -56,6 +79,7 @@ class StringDescriptor(TagDescriptor):
 
     def __set__(self, instance, value):
         instance.get()
+        snapshot(instance)
         node = self.get_node(instance)
         if node is None:
             # create the new tag
@@ -70,11 +94,15 @@ class StringAttributeDescriptor(TagDescriptor):
     """
 
     def __get__(self, instance, cls):
+        summary = self.get_summary(instance)
+        if summary is not None and self.tag in summary.attrib:
+            return summary.attrib[self.tag]
         instance.get()
         return instance.root.attrib[self.tag]
 
     def __set__(self, instance, value):
         instance.get()
+        snapshot(instance)
         instance.root.attrib[self.tag] = value
 
 
@@ -141,6 +169,52 @@ class BooleanDescriptor(StringDescriptor):
         super().__set__(instance, str(value).lower())
 
 
+def udf_type(value):
+    "Return the UDF type for a new field holding the given value."
+    if isinstance(value, six.string_types):
+        return "\n" in value and "Text" or "String"
+    elif isinstance(value, bool):
+        return "Boolean"
+    elif isinstance(value, (int, float, Decimal)):
+        return "Numeric"
+    elif isinstance(value, datetime.date):
+        return "Date"
+    raise NotImplementedError(f"Cannot handle value of type '{type(value)}' for UDF")
+
+
+def udf_text(vtype, value):
+    """Return the XML text of a value for a UDF of the given type,
+    raising TypeError if the value does not suit the type."""
+    vtype = vtype.lower()
+    if value is None:
+        return ""
+    elif vtype in ("string", "str"):
+        if not isinstance(value, six.string_types):
+            raise TypeError("String UDF requires str or unicode value")
+    elif vtype == "text":
+        if not isinstance(value, six.string_types):
+            raise TypeError("Text UDF requires str or unicode value")
+    elif vtype == "numeric":
+        if not isinstance(value, (int, float, Decimal)) and value != "":
+            raise TypeError("Numeric UDF requires int or float value")
+        value = str(value)
+    elif vtype == "boolean":
+        if not isinstance(value, bool):
+            raise TypeError("Boolean UDF requires bool value")
+        value = value and "true" or "false"
+    elif vtype == "date":
+        if not isinstance(value, datetime.date):  # Too restrictive?
+            raise TypeError("Date UDF requires datetime.date value")
+        value = str(value)
+    elif vtype == "uri":
+        if not isinstance(value, six.string_types):
+            raise TypeError("URI UDF requires str or punycode (unicode) value")
+        value = str(value)
+    else:
+        raise NotImplementedError(f"UDF type '{vtype}'")
+    return value
+
+
 class UdfDictionary:
     "Dictionary-like container of UDFs, optionally within a UDT."
 
@@ -174,6 +248,7 @@ class UdfDictionary:
         assert isinstance(name, str)
         if not self._udt:
             raise AttributeError("cannot set name for a UDF dictionary")
+        snapshot(self.instance)
         self._udt = name
         elem = self.rootnode.find(nsmap("udf:type"))
         assert elem is not None
@@ -210,7 +285,8 @@ class UdfDictionary:
                 value = value == "true"
             elif type == "date":
                 value = datetime.date(*time.strptime(value, "%Y-%m-%d")[:3])
-            self._lookup[elem.attrib["name"]] = value
+            # UDF names repeat across every entity of a type, share one copy
+            self._lookup[sys.intern(elem.attrib["name"])] = value
 
     def __contains__(self, key):
         try:
@@ -223,63 +299,29 @@ class UdfDictionary:
         return self._lookup[key]
 
     def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def get_type(self, key):
+        "Return the type of the UDF of the given name, or None if absent."
+        for node in self._elems:
+            if node.attrib["name"] == key:
+                return node.attrib["type"]
+        return None
+
+    def set(self, key, value, vtype=None):
+        """Set the value of the UDF. If the UDF is absent, it is created with
+        the given type, or else one guessed from the value."""
+        snapshot(self.instance)
         self._lookup[key] = value
         for node in self._elems:
             if node.attrib["name"] != key:
                 continue
-            vtype = node.attrib["type"].lower()
-
-            if value is None:
-                value = ""
-            elif vtype == "string":
-                if not self._is_string(value):
-                    raise TypeError("String UDF requires str or unicode value")
-            elif vtype == "str":
-                if not self._is_string(value):
-                    raise TypeError("String UDF requires str or unicode value")
-            elif vtype == "text":
-                if not self._is_string(value):
-                    raise TypeError("Text UDF requires str or unicode value")
-            elif vtype == "numeric":
-                if not isinstance(value, (int, float, Decimal)) and value != "":
-                    raise TypeError("Numeric UDF requires int or float value")
-                else:
-                    value = str(value)
-            elif vtype == "boolean":
-                if not isinstance(value, bool):
-                    raise TypeError("Boolean UDF requires bool value")
-                value = value and "true" or "false"
-            elif vtype == "date":
-                if not isinstance(value, datetime.date):  # Too restrictive?
-                    raise TypeError("Date UDF requires datetime.date value")
-                value = str(value)
-            elif vtype == "uri":
-                if not self._is_string(value):
-                    raise TypeError("URI UDF requires str or punycode (unicode) value")
-                value = str(value)
-            else:
-                raise NotImplementedError(f"UDF type '{vtype}'")
-            if not isinstance(value, str):
-                if not self._is_string(value):
-                    value = str(value).encode("UTF-8")
-            node.text = value
+            node.text = udf_text(node.attrib["type"], value)
             break
         else:  # Create new entry; heuristics for type
-            if self._is_string(value):
-                vtype = "\n" in value and "Text" or "String"
-            elif isinstance(value, bool):
-                vtype = "Boolean"
-                value = value and "true" or "false"
-            elif isinstance(value, (int, float, Decimal)):
-                vtype = "Numeric"
-                value = str(value)
-            elif isinstance(value, datetime.date):
-                vtype = "Date"
-                value = str(value)
-            else:
-                raise NotImplementedError(
-                    f"Cannot handle value of type '{type(value)}' for UDF"
-                )
+            if vtype is None:
+                vtype = udf_type(value)
+            value = udf_text(vtype, value)
             if self._udt:
                 root = self.rootnode.find(nsmap("udf:type"))
             else:
@@ -287,10 +329,6 @@ class UdfDictionary:
             elem = ElementTree.SubElement(
                 root, nsmap("udf:field"), type=vtype, name=key
             )
-            if not isinstance(value, str):
-                if not self._is_string(value):
-                    value = str(value).encode("UTF-8")
-
             elem.text = value
 
             # update the internal elements and lookup with new values
@@ -298,6 +336,7 @@ class UdfDictionary:
             self._prepare_lookup()
 
     def __delitem__(self, key):
+        snapshot(self.instance)
         del self._lookup[key]
         for node in self._elems:
             if node.attrib["name"] == key:
@@ -308,6 +347,7 @@ class UdfDictionary:
         return list(self._lookup.items())
 
     def clear(self):
+        snapshot(self.instance)
         for elem in self._elems:
             self.rootnode.remove(elem)
         self._update_elems()
@@ -374,6 +414,7 @@ class PlacementDictionaryDescriptor(TagDescriptor):
         for node in instance.root.findall(self.tag):
             key = node.find("value").text
             self.value[key] = Artifact(instance.lims, uri=node.attrib["uri"])
+        instance.lims._register_siblings(self.value.values())
         return self.value
 
 
@@ -407,6 +448,7 @@ class EntityDescriptor(TagDescriptor):
 
     def __set__(self, instance, value):
         instance.get()
+        snapshot(instance)
         node = self.get_node(instance)
         if node is None:
             # create the new tag
@@ -427,7 +469,7 @@ class EntityListDescriptor(EntityDescriptor):
         result = []
         for node in instance.root.findall(self.tag):
             result.append(self.klass(instance.lims, uri=node.attrib["uri"]))
-
+        instance.lims._register_siblings(result)
         return result
 
 
@@ -446,6 +488,7 @@ class NestedBooleanDescriptor(TagDescriptor):
         return result
 
     def __set__(self, instance, value):
+        snapshot(instance)
         rootnode = instance.root
         for rootkey in self.rootkeys:
             rootnode = rootnode.find(rootkey)
@@ -467,6 +510,7 @@ class NestedStringDescriptor(TagDescriptor):
         return result
 
     def __set__(self, instance, value):
+        snapshot(instance)
         rootnode = instance.root
         for rootkey in self.rootkeys:
             rootnode = rootnode.find(rootkey)
@@ -530,12 +574,13 @@ class NestedEntityListDescriptor(EntityListDescriptor):
             rootnode = rootnode.find(rootkey)
         for node in rootnode.findall(self.tag):
             result.append(self.klass(instance.lims, uri=node.attrib["uri"]))
-
+        instance.lims._register_siblings(result)
         return result
 
 
 class MultiPageNestedEntityListDescriptor(EntityListDescriptor):
-    """same as NestedEntityListDescriptor, but works on multiple pages, for Queues"""
+    """same as NestedEntityListDescriptor, but works on multiple pages, for Queues.
+    The following pages are fetched concurrently, without creating entities for them."""
 
     def __init__(self, tag, klass, *args):
         super(EntityListDescriptor, self).__init__(tag, klass)
@@ -546,17 +591,14 @@ class MultiPageNestedEntityListDescriptor(EntityListDescriptor):
     def __get__(self, instance, cls):
         instance.get()
         result = []
-        rootnode = instance.root
-        for rootkey in self.rootkeys:
-            rootnode = rootnode.find(rootkey)
-        for node in rootnode.findall(self.tag):
-            result.append(self.klass(instance.lims, uri=node.attrib["uri"]))
-
-        if instance.root.find("next-page") is not None:
-            next_queue_page = instance.__class__(
-                instance.lims, uri=instance.root.find("next-page").attrib.get("uri")
-            )
-            result.extend(next_queue_page.artifacts)
+        for root in instance.lims._iter_page_roots(instance.root):
+            rootnode = root
+            for rootkey in self.rootkeys:
+                rootnode = rootnode.find(rootkey)
+            if rootnode is None:
+                continue
+            for node in rootnode.findall(self.tag):
+                result.append(self.klass(instance.lims, uri=node.attrib["uri"]))
         return result
 
 
@@ -629,6 +671,7 @@ class OutputReagentList(BaseDescriptor):
         return self.value
 
     def __set__(self, instance, value):
+        snapshot(instance)
         out_r = ElementTree.Element("output-reagents")
         for artifact in value:
             out_a = ElementTree.SubElement(
@@ -643,10 +686,75 @@ class OutputReagentList(BaseDescriptor):
         instance.root.append(out_r)
 
 
+class InputOutputMapIndex:
+    """Lookup tables over the input/output maps of a Process or StepDetails.
+
+    maps: the list of (input, output) tuples, as given by InputOutputMapList.
+    by_input: input LIMS id -> list of (input, output) tuples.
+    by_output: output LIMS id -> list of (input, output) tuples.
+    by_output_type: output-type -> list of (input, output) tuples.
+    by_generation_type: output-generation-type -> list of (input, output) tuples.
+    """
+
+    def __init__(self, maps):
+        self.maps = maps
+        self.by_input = dict()
+        self.by_output = dict()
+        self.by_output_type = dict()
+        self.by_generation_type = dict()
+        for io in maps:
+            input, output = io
+            if input is not None:
+                self.by_input.setdefault(input.get("limsid"), []).append(io)
+            if output is not None:
+                self.by_output.setdefault(output.get("limsid"), []).append(io)
+                self.by_output_type.setdefault(output.get("output-type"), []).append(io)
+                self.by_generation_type.setdefault(
+                    output.get("output-generation-type"), []
+                ).append(io)
+
+    def input_ids(self):
+        "Return the unique input LIMS ids, in document order."
+        return [id for id in self.by_input if id is not None]
+
+    def output_ids(self, output_type=None):
+        """Return the unique output LIMS ids, in document order,
+        optionally only those of the given output-type."""
+        if output_type is None:
+            return [id for id in self.by_output if id is not None]
+        ids = dict()
+        for io in self.by_output_type.get(output_type, []):
+            if io[1].get("limsid") is not None:
+                ids[io[1]["limsid"]] = None
+        return list(ids)
+
+    def outputs_per_input(self, input_id, output_type=None):
+        "Return the output dictionaries of the given input LIMS id."
+        return [
+            io[1]
+            for io in self.by_input.get(input_id, [])
+            if io[1] is not None
+            and (output_type is None or io[1].get("output-type") == output_type)
+        ]
+
+    def inputs_per_output(self, output_id):
+        "Return the input dictionaries of the given output LIMS id."
+        return [io[0] for io in self.by_output.get(output_id, []) if io[0] is not None]
+
+
 class InputOutputMapList(BaseDescriptor):
     """An instance attribute yielding a list of tuples (input, output)
     where each item is a dictionary, representing the input/output
     maps of a Process instance.
+
+    The 'uri' artifact is the one kept in the cache, at its current state
+    unless the LIMS interface keeps artifact states apart. The state given
+    by the map is under 'state': io['uri'].at_state(io['state']) is the
+    artifact as it was at that state, for instance to read its QC flag at
+    the time of the step.
+
+    The list is parsed once per loaded root and shared between accesses,
+    it should not be modified by the caller.
     """
 
     def __init__(self, *args):
@@ -654,16 +762,26 @@ class InputOutputMapList(BaseDescriptor):
         self.rootkeys = args
 
     def __get__(self, instance, cls):
+        self.value = self.get_cache(instance)[1]
+        return self.value
+
+    def get_cache(self, instance):
+        "Return the cached [root, maps, index] of the instance, parsing if needed."
         instance.get()
-        self.value = []
+        cache = instance.__dict__.get("_input_output_maps")
+        if cache is not None and cache[0] is instance.root:
+            return cache
+        maps = []
         rootnode = instance.root
         for rootkey in self.rootkeys:
             rootnode = rootnode.find(rootkey)
         for node in rootnode.findall("input-output-map"):
             input = self.get_dict(instance.lims, node.find("input"))
             output = self.get_dict(instance.lims, node.find("output"))
-            self.value.append((input, output))
-        return self.value
+            maps.append((input, output))
+        cache = [instance.root, maps, None]
+        instance._input_output_maps = cache
+        return cache
 
     def get_dict(self, lims, node):
         from genologics.entities import Artifact, Process
@@ -673,20 +791,35 @@ class InputOutputMapList(BaseDescriptor):
         result = dict()
         for key in ["limsid", "output-type", "output-generation-type"]:
             try:
-                result[key] = node.attrib[key]
+                result[key] = sys.intern(node.attrib[key])
             except KeyError:
                 pass
-            for uri in ["uri", "post-process-uri"]:
-                try:
-                    result[uri] = Artifact(lims, uri=node.attrib[uri])
-                except KeyError:
-                    pass
+        for uri in ["uri", "post-process-uri"]:
+            try:
+                result[uri] = Artifact(lims, uri=node.attrib[uri])
+            except KeyError:
+                pass
+        if "uri" in result:
+            state = parse_qs(urlparse(node.attrib["uri"]).query).get("state")
+            result["state"] = state[0] if state else None
         node = node.find("parent-process")
         if node is not None:
             result["parent-process"] = Process(lims, node.attrib["uri"])
         return result
 
 
+class InputOutputMapIndexDescriptor(InputOutputMapList):
+    """An instance attribute yielding an InputOutputMapIndex over the
+    input/output maps, built once per loaded root.
+    """
+
+    def __get__(self, instance, cls):
+        cache = self.get_cache(instance)
+        if cache[2] is None:
+            cache[2] = InputOutputMapIndex(cache[1])
+        return cache[2]
+
+
 class ProcessTypeParametersDescriptor:
     def __getitem__(self, index):
         return self.params[index]
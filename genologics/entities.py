@@ -6,7 +6,9 @@ Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
 Copyright (C) 2012 Per Kraulis
 """
 
+import hashlib
 import logging
+import sys
 from urllib.parse import parse_qs, urlparse, urlsplit, urlunparse
 from xml.etree import ElementTree
 
@@ -17,6 +19,7 @@ from genologics.descriptors import (
     EntityDescriptor,
     EntityListDescriptor,
     ExternalidListDescriptor,
+    InputOutputMapIndexDescriptor,
     InputOutputMapList,
     IntegerAttributeDescriptor,
     IntegerDescriptor,
@@ -45,6 +48,13 @@ from genologics.descriptors import (
 logger = logging.getLogger(__name__)
 
 
+def _intern(value):
+    "Intern strings that are repeated across cached entities (URIs, LIMS ids)."
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
 class SampleHistory:
     """Class handling the history generation for a given sample/artifact
     AFAIK the only fields of the history that are read are proc.type and outart"""
@@ -57,8 +67,10 @@ class SampleHistory:
         lims=None,
         pro_per_art=None,
         test=False,
+        genealogy=None,
     ):
         self.processes_per_artifact = pro_per_art
+        self.genealogy = genealogy
         if lims:
             self.lims = lims
             if not (test):
@@ -107,7 +119,9 @@ class SampleHistory:
         This function starts from the output,
         and creates an entry like this : output -> (process, input)"""
         samp_art_map = {}
-        if self.sample_name:
+        if self.sample_name and self.genealogy is not None:
+            samp_art_map = self.genealogy.sample_artifact_map(self.sample_name)
+        elif self.sample_name:
             artifacts = self.lims.get_artifacts(
                 sample_name=self.sample_name, type="Analyte", resolve=False
             )
@@ -128,7 +142,14 @@ class SampleHistory:
         This one iterates over Artifact.parent_process and Process.all_inputs()
         Then, it takes all the child processes for each input (because we want
         qc processes too) and puts everything in a dictionnary.
+        If a genologics.genealogy.Genealogy was given, the history is
+        computed from it without querying the lims.
         """
+        if self.genealogy is not None:
+            self.history, self.history_list = self.genealogy.sample_history(
+                self.sample_name, out_art, in_art
+            )
+            return
         history = {}
         # getting the list of all expected analytes.
         artifacts = self.lims.get_artifacts(
@@ -308,6 +329,7 @@ class Entity:
                 pass
             else:
                 raise ValueError("Entity uri and id can't be both None")
+        uri = cls._canonical_uri(lims, uri)
         try:
             return lims.cache[uri]
         except KeyError:
@@ -320,12 +342,22 @@ class Entity:
                 return
             if not uri:
                 uri = lims.get_uri(self._URI, id)
+            uri = _intern(self._canonical_uri(lims, uri))
             lims.cache[uri] = self
             self.root = None
         self.lims = lims
         self._uri = uri
+        self._id = None
+        self._id_uri = None
+        # Node from a list query, serving a few fields until the root is loaded
+        self._summary = None
         self.root = None
 
+    @classmethod
+    def _canonical_uri(cls, lims, uri):
+        "Return the URI under which the entity is kept in the cache."
+        return uri
+
     def __str__(self):
         return f"{self.__class__.__name__}({self.id})"
 
@@ -341,25 +373,118 @@ class Entity:
 
     @property
     def id(self):
-        "Return the LIMS id; obtained from the URI."
-        parts = urlsplit(self.uri)
-        return parts.path.split("/")[-1]
+        """Return the LIMS id; obtained from the URI.
+        The id is parsed once and memoized until the URI changes."""
+        uri = self.uri
+        if self._id_uri is not uri:
+            self._id = _intern(urlsplit(uri).path.split("/")[-1])
+            self._id_uri = uri
+        return self._id
+
+    @property
+    def root(self):
+        "The ElementTree of the instance, or None if not loaded yet."
+        return self._root
+
+    @root.setter
+    def root(self, root):
+        self._root = root
+        # Digest of the XML as loaded or last saved; None if the root was
+        # set directly rather than loaded from the LIMS
+        self._clean_digest = None
+
+    def _set_loaded(self, root):
+        """Set the XML as loaded from the LIMS, recording its digest so that
+        changes, including direct edits of the root, can be detected. The
+        node of a list page it came from, if any, is no longer needed."""
+        self.root = root
+        if root is not None:
+            self._clean_digest = self._digest()
+            self._summary = None
+
+    def _digest(self, data=None):
+        if data is None:
+            data = self.xml()
+        return hashlib.sha1(data).digest()
+
+    def _snapshot(self):
+        """Record the digest of the unmodified XML, if the root was set
+        directly rather than loaded, and register the change with the
+        active unit of work, if any."""
+        if self._clean_digest is None and self.root is not None:
+            self._clean_digest = self._digest()
+        unit = self.lims._unit_of_work
+        if unit is not None:
+            unit.add(self)
+
+    def is_modified(self):
+        """Return True if the XML differs from the one loaded or last saved,
+        comparing their digests, so that direct edits of the root are
+        detected too. An instance whose root was not loaded from the LIMS
+        is assumed to be modified, unless its XML was snapshotted by a
+        change made through a descriptor or an UDF dictionary.
+        """
+        if self._clean_digest is None:
+            return True
+        return self._digest() != self._clean_digest
 
     def get(self, force=False):
         "Get the XML data for this instance."
         if not force and self.root is not None:
             return
-        self.root = self.lims.get(self.uri)
-
-    def put(self):
-        "Save this instance by doing PUT of its serialized XML."
+        if not force and self.lims.backing_store is not None:
+            if self._load_stored():
+                return
+        if not force and self.lims.batch_on_miss:
+            self.lims._get_siblings(self)
+            if self.root is not None:
+                return
+        self._set_loaded(self.lims.get(self.uri))
+
+    def _load_stored(self):
+        "Load the XML from the backing store of the LIMS, if it holds it."
+        root = self.lims.backing_store.load(self)
+        if root is None:
+            return False
+        self._set_loaded(root)
+        return True
+
+    def put(self, force=False):
+        """Save this instance by doing PUT of its serialized XML.
+        Nothing is sent if the XML is unchanged since it was loaded,
+        unless force is True. Return True if a PUT was done.
+        Within a unit of work, the PUT is deferred until the unit is flushed."""
+        unit = self.lims._unit_of_work
+        if unit is not None:
+            unit.add(self, force=force)
+            return False
+        return self._put(force=force)
+
+    def _put(self, force=False):
         data = self.lims.tostring(ElementTree.ElementTree(self.root))
-        self.lims.put(self.uri, data)
+        digest = self._digest(data)
+        if not force and digest == self._clean_digest:
+            logger.debug(f"{self} is unchanged, skipping PUT")
+            return False
+        if not self._apply_response(self.lims.put(self.uri, data)):
+            self._clean_digest = digest
+        self.lims._written([self.__class__])
+        return True
 
     def post(self):
         "Save this instance with POST"
         data = self.lims.tostring(ElementTree.ElementTree(self.root))
-        self.lims.post(self.uri, data)
+        self._apply_response(self.lims.post(self.uri, data))
+        self.lims._written([self.__class__])
+
+    def _apply_response(self, root):
+        """Replace the XML of the instance by the one returned by the LIMS
+        after a write, so that values set by the server are up to date.
+        Return False if the response does not describe the instance."""
+        if not isinstance(root, ElementTree.Element) or root.tag != self.root.tag:
+            return False
+        self._set_loaded(root)
+        return True
 
     def xml(self):
         return self.lims.tostring(ElementTree.ElementTree(self.root))
@@ -395,8 +520,9 @@ class Entity:
         """Create an instance from attributes then post it to the LIMS"""
         instance = cls._create(lims, creation_tag=creation_tag, **kwargs)
         data = lims.tostring(ElementTree.ElementTree(instance.root))
-        instance.root = lims.post(uri=lims.get_uri(cls._URI), data=data)
+        instance._set_loaded(lims.post(uri=lims.get_uri(cls._URI), data=data))
         instance._uri = instance.root.attrib["uri"]
+        lims._written([cls])
         return instance
 
 
@@ -547,8 +673,10 @@ class Sample(Entity):
         position_element = ElementTree.SubElement(location, "value")
         position_element.text = position
         data = lims.tostring(ElementTree.ElementTree(instance.root))
-        instance.root = lims.post(uri=lims.get_uri(cls._URI), data=data)
+        instance._set_loaded(lims.post(uri=lims.get_uri(cls._URI), data=data))
         instance._uri = instance.root.attrib["uri"]
+        # Creating a sample creates its analyte too
+        lims._written([cls, Artifact])
         return instance
 
 
@@ -653,6 +781,7 @@ class Process(Entity):
     technician = EntityDescriptor("technician", Researcher)
     protocol_name = StringDescriptor("protocol-name")
     input_output_maps = InputOutputMapList()
+    input_output_index = InputOutputMapIndexDescriptor()
     udf = UdfDictionaryDescriptor()
     udt = UdtDictionaryDescriptor()
     files = EntityListDescriptor(nsmap("file:file"), File)
@@ -665,70 +794,84 @@ class Process(Entity):
         self, inart, ResultFile=False, SharedResultFile=False, Analyte=False
     ):
         """Getting all the output artifacts related to a particual input artifact"""
-
-        inouts = [io for io in self.input_output_maps if io[0]["limsid"] == inart]
+        output_type = None
         if ResultFile:
-            inouts = [io for io in inouts if io[1]["output-type"] == "ResultFile"]
+            output_type = "ResultFile"
         elif SharedResultFile:
-            inouts = [io for io in inouts if io[1]["output-type"] == "SharedResultFile"]
+            output_type = "SharedResultFile"
         elif Analyte:
-            inouts = [io for io in inouts if io[1]["output-type"] == "Analyte"]
-        outs = [io[1]["uri"] for io in inouts]
-        return outs
+            output_type = "Analyte"
+        outputs = self.input_output_index.outputs_per_input(inart, output_type)
+        return [output["uri"] for output in outputs]
+
+    def inputs_per_sample(self):
+        """Map each sample name to the input artifacts derived from it.
+        Inputs and their samples are retrieved with batch calls."""
+        inputs = self.all_inputs(unique=True, resolve=True)
+        samples = dict()
+        for inp in inputs:
+            for samp in inp.samples:
+                samples[samp.uri] = samp
+        self.lims.get_batch(list(samples.values()))
+        result = dict()
+        for inp in inputs:
+            for samp in inp.samples:
+                ins = result.setdefault(samp.name, [])
+                if inp not in ins:
+                    ins.append(inp)
+        return result
 
     def input_per_sample(self, sample):
         """gettiung all the input artifacts dereved from the specifyed sample"""
-        ins_all = self.all_inputs()
-        ins = []
-        for inp in ins_all:
-            for samp in inp.samples:
-                if samp.name == sample and inp not in ins:
-                    ins.append(inp)
-        return ins
+        return self.inputs_per_sample().get(sample, [])
 
     def all_inputs(self, unique=True, resolve=False):
         """Retrieving all input artifacts from input_output_maps
         if unique is true, no duplicates are returned.
         """
-        # if the process has no input, that is not standard and we want to know about it
-        try:
-            ids = [io[0]["limsid"] for io in self.input_output_maps]
-        except TypeError:
-            logger.error("Process ", self, " has no input artifacts")
-            raise TypeError
         if unique:
-            ids = list(frozenset(ids))
+            ids = self.input_output_index.input_ids()
+        else:
+            # if the process has no input, that is not standard and we want to know about it
+            try:
+                ids = [io[0]["limsid"] for io in self.input_output_maps]
+            except TypeError:
+                logger.error("Process ", self, " has no input artifacts")
+                raise TypeError
+        artifacts = [Artifact(self.lims, id=id) for id in ids if id is not None]
         if resolve:
-            return self.lims.get_batch(
-                [Artifact(self.lims, id=id) for id in ids if id is not None]
-            )
+            return self.lims.get_batch(artifacts)
         else:
-            return [Artifact(self.lims, id=id) for id in ids if id is not None]
+            self.lims._register_siblings(artifacts)
+            return artifacts
 
     def all_outputs(self, unique=True, resolve=False):
         """Retrieving all output artifacts from input_output_maps
         if unique is true, no duplicates are returned.
         """
-        # Given how ids is structured, io[1] might be None : some process don't have an output.
-        ids = [io[1]["limsid"] for io in self.input_output_maps if io[1] is not None]
         if unique:
-            ids = list(frozenset(ids))
+            ids = self.input_output_index.output_ids()
+        else:
+            # Given how ids is structured, io[1] might be None : some process don't have an output.
+            ids = [
+                io[1]["limsid"] for io in self.input_output_maps if io[1] is not None
+            ]
+        artifacts = [Artifact(self.lims, id=id) for id in ids if id is not None]
         if resolve:
-            return self.lims.get_batch(
-                [Artifact(self.lims, id=id) for id in ids if id is not None]
-            )
+            return self.lims.get_batch(artifacts)
         else:
-            return [Artifact(self.lims, id=id) for id in ids if id is not None]
+            self.lims._register_siblings(artifacts)
+            return artifacts
 
     def shared_result_files(self):
         """Retreve all resultfiles of output-generation-type PerAllInputs."""
-        artifacts = self.all_outputs(unique=True)
-        return [a for a in artifacts if a.output_type == "SharedResultFile"]
+        ids = self.input_output_index.output_ids(output_type="SharedResultFile")
+        return [Artifact(self.lims, id=id) for id in ids]
 
     def result_files(self):
         """Retreve all resultfiles of output-generation-type perInput."""
-        artifacts = self.all_outputs(unique=True)
-        return [a for a in artifacts if a.output_type == "ResultFile"]
+        ids = self.input_output_index.output_ids(output_type="ResultFile")
+        return [Artifact(self.lims, id=id) for id in ids]
 
     def analytes(self):
         """Retreving the output Analytes of the process, if existing.
@@ -745,8 +888,14 @@ class Process(Entity):
         return analytes, info
 
     def parent_processes(self):
-        """Retrieving all parent processes through the input artifacts"""
-        return [i_a.parent_process for i_a in self.all_inputs(unique=True)]
+        """Retrieving all parent processes through the input artifacts.
+        Inputs are retrieved with a batch call and the parent processes
+        with concurrent GETs."""
+        parents = [
+            i_a.parent_process for i_a in self.all_inputs(unique=True, resolve=True)
+        ]
+        self.lims.get_many([p for p in parents if p is not None])
+        return parents
 
     def output_containers(self):
         """Retrieve all unique output containers"""
@@ -790,22 +939,55 @@ class Artifact(Entity):
         """Returns the input artifact ids of the parrent process."""
         input_artifact_list = []
         try:
-            for tuple in self.parent_process.input_output_maps:
-                if tuple[1]["limsid"] == self.id:
-                    input_artifact_list.append(tuple[0]["uri"])  # ['limsid'])
+            index = self.parent_process.input_output_index
+            for input in index.inputs_per_output(self.id):
+                input_artifact_list.append(input["uri"])  # ['limsid'])
         except:
             pass
         return input_artifact_list
 
+    @classmethod
+    def _canonical_uri(cls, lims, uri):
+        """Drop the state from artifact URIs, unless the LIMS interface
+        keeps one entity per artifact state."""
+        if uri and "?" in uri and not lims.artifact_states:
+            return uri.split("?", 1)[0]
+        return uri
+
     def get_state(self):
-        "Parse out the state value from the URI."
-        parts = urlparse(self.uri)
+        """Parse out the state value from the URI, or from the URI given
+        in the XML for artifacts kept independently of their state.
+        For those, an artifact that is neither loaded nor from a list
+        is loaded first, with a GET."""
+        uri = self.uri
+        if "?" not in uri:
+            node = self.root
+            if node is None:
+                node = self._summary
+            if node is None:
+                self.get()
+                node = self.root
+            uri = node.attrib.get("uri", uri)
+        parts = urlparse(uri)
         params = parse_qs(parts.query)
         try:
             return params["state"][0]
         except (KeyError, IndexError):
             return None
 
+    def at_state(self, state):
+        """Return the artifact as it was at the given state, as a separate
+        entity that is not kept in the cache. With a state of None, return
+        the artifact itself; when the LIMS interface keeps artifact states
+        apart, return the cached entity of that state."""
+        if state is None:
+            return self
+        if self.lims.artifact_states:
+            return Artifact(self.lims, uri=f"{self.stateless.uri}?state={state}")
+        snapshot = Artifact(self.lims, _create_new=True)
+        snapshot._uri = f"{self.stateless.uri}?state={state}"
+        return snapshot
+
     @property
     def container(self):
         "The container where the artifact is located, or None"
@@ -869,6 +1051,7 @@ class StepPools(Entity):
         self.available_inputs = self._available_inputs
 
     def set_available_inputs(self, available_inputs):
+        self._snapshot()
         available_inputs_root = self.root.find("available-inputs")
         available_inputs_root.clear()
         for input_art in available_inputs:
@@ -916,6 +1099,7 @@ class StepPools(Entity):
         return self._pools
 
     def set_pools(self, pools):
+        self._snapshot()
         pool_root = self.root.find("pooled-inputs")
         pool_root.clear()
         for idx, pool_obj in enumerate(pools):
@@ -962,9 +1146,11 @@ class StepPlacements(Entity):
     def set_placement_list(self, value):
         containers = set()
         self.get_placement_list()
+        self._snapshot()
         placement_dict = {x[0].stateless.uri: x for x in value}
         for node in self.root.find("output-placements").findall("output-placement"):
-            location = placement_dict[node.attrib["uri"]][1]
+            artifact = Artifact(self.lims, uri=node.attrib["uri"])
+            location = placement_dict[artifact.stateless.uri][1]
             container = location[0]
             well = location[1]
             if container and location:
@@ -1073,10 +1259,11 @@ class StepActions(Entity):
         return actions
 
     def set_next_actions(self, actions):
+        self._snapshot()
         action_dict = {a["artifact"].uri: a for a in actions}
         for node in self.root.find("next-actions").findall("next-action"):
             art_uri = node.attrib.get("artifact-uri")
-            action = action_dict[art_uri]
+            action = action_dict[Artifact(self.lims, uri=art_uri).uri]
             if "action" in action:
                 node.attrib["action"] = action.get("action")
                 if "step-uri" in action:
@@ -1136,6 +1323,7 @@ class StepDetails(Entity):
     """Detail associated with a step"""
 
     input_output_maps = InputOutputMapList("input-output-maps")
+    input_output_index = InputOutputMapIndexDescriptor("input-output-maps")
     udf = UdfDictionaryDescriptor("fields")
     udt = UdtDictionaryDescriptor("fields")
 
@@ -1164,10 +1352,37 @@ class Step(Entity):
 
     def advance(self):
         self.get()
-        self.root = self.lims.post(
-            uri=f"{self.uri}/advance",
-            data=self.lims.tostring(ElementTree.ElementTree(self.root)),
+        self._set_loaded(
+            self.lims.post(
+                uri=f"{self.uri}/advance",
+                data=self.lims.tostring(ElementTree.ElementTree(self.root)),
+            )
         )
+        self.lims.invalidate(self._advanced_entities())
+
+    def _advanced_entities(self):
+        """Return the entities known to be changed by advancing the step:
+        its parts and the artifacts of its loaded details and actions."""
+        parts = [
+            self.lims.cache.get(node.attrib["uri"])
+            for node in self.root
+            if node.attrib.get("uri", "").startswith(self.uri + "/")
+        ]
+        entities = [part for part in parts if part is not None]
+        for part in entities[:]:
+            if part.root is None:
+                continue
+            if isinstance(part, StepDetails):
+                for input, output in part.input_output_maps:
+                    entities.append(input["uri"])
+                    if output is not None:
+                        entities.append(output["uri"])
+            elif isinstance(part, StepActions):
+                entities.extend(action["artifact"] for action in part.next_actions)
+        entities.extend(
+            e for e in list(self.lims.cache.values()) if isinstance(e, Queue)
+        )
+        return entities
 
     @property
     def reagent_lots(self):
@@ -1208,8 +1423,9 @@ class Step(Entity):
 
         data = lims.tostring(ElementTree.ElementTree(instance.root))
 
-        instance.root = lims.post(uri=lims.get_uri(cls._URI), data=data)
+        instance._set_loaded(lims.post(uri=lims.get_uri(cls._URI), data=data))
         instance._uri = instance.root.attrib["uri"]
+        lims._written([cls, Process, Artifact])
 
         return instance
 
@@ -1297,7 +1513,7 @@ class ReagentType(Entity):
     def __init__(self, lims, uri=None, id=None):
         super().__init__(lims, uri, id)
         assert self.uri is not None
-        self.root = lims.get(self.uri)
+        self._set_loaded(lims.get(self.uri))
         self.sequence = None
         for t in self.root.findall("special-type"):
             if t.attrib.get("name") == "Index":
@@ -1307,7 +1523,8 @@ class ReagentType(Entity):
 
 
 class Queue(Entity):
-    """Queue of a given step. Will recursively get all the pages of artifacts, and therefore, can be quite slow to load"""
+    """Queue of a given step. The artifacts attribute gets all the pages of artifacts,
+    and therefore, can be quite slow to load; iter_artifacts() streams them instead."""
 
     _URI = "queues"
     _TAG = "queue"
@@ -1315,6 +1532,27 @@ class Queue(Entity):
 
     artifacts = MultiPageNestedEntityListDescriptor("artifact", Artifact, "artifacts")
 
+    def iter_artifacts(self, max_workers=None):
+        """Yield (artifact, queue time, location) for each artifact in the queue,
+        the location being a (container, well) tuple as Artifact.location.
+        The following pages of the queue are fetched ahead concurrently while
+        iterating, and no longer once the iteration is stopped."""
+        self.get()
+        for root in self.lims._iter_page_roots(self.root, max_workers):
+            artifacts = root.find("artifacts")
+            if artifacts is None:
+                continue
+            for node in artifacts.findall("artifact"):
+                artifact = Artifact(self.lims, uri=node.attrib["uri"])
+                location = (None, None)
+                container = node.find("location/container")
+                if container is not None:
+                    location = (
+                        Container(self.lims, uri=container.attrib["uri"]),
+                        node.find("location/value").text,
+                    )
+                yield artifact, node.findtext("queue-time"), location
+
 
 # Set class-interdependent class variables
 setattr(Sample, "artifact", EntityDescriptor("artifact", Artifact))
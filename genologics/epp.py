@@ -369,8 +369,7 @@ class CopyField:
     def _set_udf(self, elt, udf_name, val):
         try:
             elt.udf[udf_name] = val
-            elt.put()
-            return True
+            return elt.put()
         except (TypeError, HTTPError) as e:
             print(f"Error while updating element: {e}", file=sys.stderr)
             sys.exit(-1)
@@ -0,0 +1,324 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+In-memory genealogy graph of the artifacts and processes of a project.
+
+The graph is loaded with a handful of bulk calls (batch retrieves of the
+samples and artifacts, multi-value process queries and concurrent process
+GETs) and then answers ancestor, descendant, path and sample history
+queries without further requests to the LIMS.
+"""
+
+import json
+import logging
+
+from genologics.entities import Process
+from genologics.lims import MAX_WORKERS, _raise_first
+
+logger = logging.getLogger(__name__)
+
+
+def load_lineage(lims, samples, max_workers=MAX_WORKERS):
+    """Load in bulk the given samples, their artifacts, the processes that
+    produced them and the processes that used them.
+
+    Return (samples, artifacts, processes), lists of loaded entities.
+    Processes that could not be retrieved are logged and left out.
+    """
+    samples = list(samples)
+    _raise_first(lims._load_entities(samples, max_workers))
+    artifacts = dict()
+    for sample_artifacts in lims.artifacts_by_sample(samples).values():
+        for artifact in sample_artifacts:
+            artifacts[artifact.id] = artifact
+    artifacts = list(artifacts.values())
+
+    processes = dict()
+    for artifact in artifacts:
+        node = artifact.root.find("parent-process")
+        if node is not None:
+            process = Process(lims, uri=node.attrib["uri"])
+            processes[process.id] = process
+    used_by = lims.processes_by_input(artifacts, max_workers=max_workers)
+    for artifact_processes in used_by.values():
+        for process in artifact_processes:
+            processes[process.id] = process
+    failures = lims._load_entities(processes.values(), max_workers)
+    for process, error in failures.items():
+        logger.warning(f"Could not retrieve {process}: {error}")
+        del processes[process.id]
+    return samples, artifacts, list(processes.values())
+
+
+def build_processes_per_artifact(
+    lims, project=None, samples=None, max_workers=MAX_WORKERS
+):
+    """Build, in one pass over a project or a list of samples, the maps
+    SampleHistory otherwise queries artifact by artifact.
+
+    Return (processes_per_artifact, sample_artifact_maps) where
+    processes_per_artifact maps each artifact id to the processes using it
+    as input, to be given as pro_per_art, and sample_artifact_maps maps each
+    sample name to the output -> (process, input) map of that sample.
+    """
+    genealogy = Genealogy(lims)
+    if project is not None:
+        samples = lims.get_samples(projectlimsid=project.id)
+    genealogy.load_samples(samples, max_workers=max_workers)
+    sample_artifact_maps = {
+        sample.name: genealogy.sample_artifact_map(sample.name) for sample in samples
+    }
+    return genealogy.processes_per_artifact(), sample_artifact_maps
+
+
+class Genealogy:
+    """Directed acyclic graph of artifacts and processes, keyed by LIMS id.
+
+    artifact_type: artifact id -> artifact type (Analyte, ResultFile...)
+    artifact_samples: artifact id -> list of sample names
+    parent_process: artifact id -> id of the process that produced it
+    used_by: artifact id -> ids of the processes using it as input
+    process_inputs: process id -> input artifact ids
+    process_outputs: process id -> output artifact ids
+    process_io: process id -> {input artifact id: output artifact ids}
+    process_info: process id -> {"date", "type", "name"}
+    """
+
+    def __init__(self, lims):
+        self.lims = lims
+        self.artifact_type = dict()
+        self.artifact_samples = dict()
+        self.parent_process = dict()
+        self.used_by = dict()
+        self.process_inputs = dict()
+        self.process_outputs = dict()
+        self.process_io = dict()
+        self.process_info = dict()
+
+    def load_project(self, project, max_workers=MAX_WORKERS):
+        "Load the genealogy of all the samples of the given project."
+        samples = self.lims.get_samples(projectlimsid=project.id)
+        self.load_samples(samples, max_workers=max_workers)
+
+    def load_samples(self, samples, max_workers=MAX_WORKERS):
+        """Load the genealogy of the given samples: their artifacts, the
+        processes that produced them and the processes that used them."""
+        _, artifacts, processes = load_lineage(self.lims, samples, max_workers)
+        self.add_artifacts(artifacts)
+        self.add_processes(processes)
+
+    def add_artifacts(self, artifacts):
+        "Add loaded artifacts to the graph."
+        for artifact in artifacts:
+            self.artifact_type[artifact.id] = artifact.type
+            self.artifact_samples[artifact.id] = [s.name for s in artifact.samples]
+
+    def add_processes(self, processes):
+        "Add loaded processes and their input-output edges to the graph."
+        for process in processes:
+            pid = process.id
+            # Read the process type from the process XML, without loading it
+            node = process.root.find("type")
+            type_id = type_name = None
+            if node is not None:
+                type_id = node.attrib["uri"].split("/")[-1]
+                type_name = node.text.strip() if node.text else None
+            self.process_info[pid] = {
+                "date": process.date_run,
+                "type": type_id,
+                "name": type_name,
+            }
+            index = process.input_output_index
+            self.process_inputs[pid] = index.input_ids()
+            self.process_outputs[pid] = index.output_ids()
+            io = dict()
+            for input_id in self.process_inputs[pid]:
+                used_by = self.used_by.setdefault(input_id, [])
+                if pid not in used_by:
+                    used_by.append(pid)
+                io[input_id] = [
+                    output["limsid"] for output in index.outputs_per_input(input_id)
+                ]
+            self.process_io[pid] = io
+            for output_id in self.process_outputs[pid]:
+                self.parent_process[output_id] = pid
+
+    def parents(self, artifact_id):
+        "Return the ids of the artifacts the given one was derived from."
+        pid = self.parent_process.get(artifact_id)
+        if pid is None:
+            return []
+        return [
+            i for i, outputs in self.process_io[pid].items() if artifact_id in outputs
+        ]
+
+    def children(self, artifact_id):
+        "Return the ids of the artifacts derived from the given one."
+        result = []
+        for pid in self.used_by.get(artifact_id, []):
+            for output_id in self.process_io[pid].get(artifact_id, []):
+                if output_id not in result:
+                    result.append(output_id)
+        return result
+
+    def _walk(self, artifact_id, step):
+        seen = {artifact_id}
+        todo = [artifact_id]
+        result = []
+        while todo:
+            for next_id in step(todo.pop()):
+                if next_id not in seen:
+                    seen.add(next_id)
+                    result.append(next_id)
+                    todo.append(next_id)
+        return result
+
+    def ancestors(self, artifact_id):
+        "Return the ids of all the artifacts upstream of the given one."
+        return self._walk(artifact_id, self.parents)
+
+    def descendants(self, artifact_id):
+        "Return the ids of all the artifacts downstream of the given one."
+        return self._walk(artifact_id, self.children)
+
+    def path(self, from_id, to_id):
+        """Return the list of artifact ids leading from from_id down to to_id,
+        both included, or None if to_id does not derive from from_id."""
+        previous = {from_id: None}
+        todo = [from_id]
+        while todo:
+            current = todo.pop(0)
+            if current == to_id:
+                path = []
+                while current is not None:
+                    path.append(current)
+                    current = previous[current]
+                return path[::-1]
+            for next_id in self.children(current):
+                if next_id not in previous:
+                    previous[next_id] = current
+                    todo.append(next_id)
+        return None
+
+    def _is_sample_analyte(self, artifact_id, sample_name):
+        return self.artifact_type.get(
+            artifact_id
+        ) == "Analyte" and sample_name in self.artifact_samples.get(artifact_id, [])
+
+    def _step_info(self, pid, input_id, output_id):
+        info = self.process_info[pid]
+        return {
+            "date": info["date"],
+            "id": pid,
+            "outart": output_id,
+            "inart": input_id,
+            "type": info["type"],
+            "name": info["name"],
+        }
+
+    def sample_history(self, sample_name, output_artifact, input_artifact=None):
+        """Return the (history, history_list) of SampleHistory for the given
+        sample, starting from output_artifact (and input_artifact) ids."""
+        history = {}
+        inputs = []
+        if input_artifact:
+            starting_art = input_artifact
+            inputs.append(input_artifact)
+            history[input_artifact] = {}
+            for pid in self.used_by.get(input_artifact, []):
+                outart = (
+                    output_artifact
+                    if output_artifact in self.process_outputs[pid]
+                    else None
+                )
+                history[input_artifact][pid] = self._step_info(
+                    pid, input_artifact, outart
+                )
+        else:
+            starting_art = output_artifact
+        while self._is_sample_analyte(starting_art, sample_name):
+            parent = self.parent_process.get(starting_art)
+            if parent is None:
+                break
+            for input_id in self.process_inputs[parent]:
+                if self._is_sample_analyte(input_id, sample_name):
+                    history[input_id] = {}
+                    for pid in self.used_by.get(input_id, []):
+                        outart = starting_art if pid == parent else None
+                        history[input_id][pid] = self._step_info(pid, input_id, outart)
+                    inputs.append(input_id)
+                    starting_art = input_id
+                    break
+            else:
+                break
+        return history, inputs
+
+    def process_history(self, artifact_id, sample_name):
+        """Return the ids of the processes leading to the given artifact,
+        staying within the analytes of the given sample."""
+        history = []
+        starting_art = artifact_id
+        while self._is_sample_analyte(starting_art, sample_name):
+            parent = self.parent_process.get(starting_art)
+            if parent is None:
+                break
+            history.append(parent)
+            for input_id in self.process_inputs[parent]:
+                if self._is_sample_analyte(input_id, sample_name):
+                    starting_art = input_id
+                    break
+            else:
+                break
+        return history
+
+    def processes_per_artifact(self):
+        """Return the processes using each artifact of the graph as input,
+        keyed by artifact id, as expected by SampleHistory's pro_per_art."""
+        return {
+            artifact_id: [
+                Process(self.lims, id=pid) for pid in self.used_by.get(artifact_id, [])
+            ]
+            for artifact_id in self.artifact_type
+        }
+
+    def sample_artifact_map(self, sample_name):
+        """Return the map of SampleHistory.make_sample_artifact_map for the
+        given sample: output analyte id -> (parent process, input id)."""
+        samp_art_map = {}
+        for artifact_id in self.artifact_type:
+            if not self._is_sample_analyte(artifact_id, sample_name):
+                continue
+            for input_id in self.parents(artifact_id):
+                if sample_name in self.artifact_samples.get(input_id, []):
+                    samp_art_map[artifact_id] = (
+                        Process(self.lims, id=self.parent_process[artifact_id]),
+                        input_id,
+                    )
+        return samp_art_map
+
+    def save(self, path):
+        "Persist the graph as JSON to the given path."
+        data = {
+            key: getattr(self, key)
+            for key in (
+                "artifact_type",
+                "artifact_samples",
+                "parent_process",
+                "used_by",
+                "process_inputs",
+                "process_outputs",
+                "process_io",
+                "process_info",
+            )
+        }
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, lims, path):
+        "Return a graph previously persisted with save()."
+        genealogy = cls(lims)
+        with open(path) as f:
+            data = json.load(f)
+        for key, value in data.items():
+            setattr(genealogy, key, value)
+        return genealogy
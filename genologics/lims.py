@@ -19,23 +19,31 @@ __all__ = [
     "Lims",
 ]
 
+import logging
 import os
 import re
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 # python 2.7, 3+ compatibility
-from urllib.parse import urlencode, urljoin
+from urllib.parse import parse_qs, urlencode, urljoin, urlparse
 from xml.etree import ElementTree
 
 import requests
 
 from genologics.constants import nsmap
+from genologics.descriptors import udf_text, udf_type
+from genologics.query import Query
 
 from .entities import (
     Artifact,
     Automation,
     Container,
     Containertype,
+    Entity,
     File,
     Instrument,
     Lab,
@@ -43,6 +51,7 @@ from .entities import (
     Processtype,
     Project,
     Protocol,
+    Queue,
     ReagentKit,
     ReagentLot,
     ReagentType,
@@ -56,7 +65,88 @@ from .entities import (
 # - Exception ElementTree.ParseError does not exist
 # - ElementTree.ElementTree.write does not take arg. xml_declaration
 
+logger = logging.getLogger(__name__)
+
 TIMEOUT = 16
+# Number of concurrent requests used when loading many entities
+MAX_WORKERS = 8
+# Number of entities sent in a single batch request
+BATCH_SIZE = 500
+# Entity tags supported by the batch retrieve and update endpoints
+BATCH_TAGS = ("artifact", "container", "file", "sample")
+# Maximum length of the encoded query string of a list query; longer
+# queries are split into several ones on their multi-value parameters
+MAX_QUERY_LENGTH = 4000
+
+
+def _raise_first(failures):
+    "Raise the first error of a dictionary of failures, if any."
+    if failures:
+        raise next(iter(failures.values()))
+
+
+def _task_failures(tasks):
+    """Wait for the (future, entities) pairs of tasks and return a
+    dictionary of the entities of the failed ones, mapped to the exception
+    raised for them."""
+    failures = dict()
+    for future, entities in tasks:
+        error = future.exception()
+        if error is not None:
+            for entity in entities:
+                failures[entity] = error
+    return failures
+
+
+class _SiblingWindow:
+    "Entities obtained together, to be loaded as a group on first access."
+
+    def __init__(self, entities):
+        self.refs = [weakref.ref(entity) for entity in entities]
+        self.claimed = False
+        self.done = threading.Event()
+
+    def members(self):
+        "Return the entities of the window still alive."
+        members = [ref() for ref in self.refs]
+        return [entity for entity in members if entity is not None]
+
+
+def _split_params(params, max_length=None):
+    """Split query parameters whose encoded length exceeds max_length,
+    MAX_QUERY_LENGTH by default, into a list of parameters each fitting in
+    it, by dividing the values of the longest multi-value parameter.
+    Return [params] if no split is needed."""
+    if max_length is None:
+        max_length = MAX_QUERY_LENGTH
+    if len(urlencode(params, doseq=True)) <= max_length:
+        return [params]
+    multi = [
+        key
+        for key, value in params.items()
+        if isinstance(value, (list, tuple, set)) and len(value) > 1
+    ]
+    if not multi:
+        return [params]
+    key = max(multi, key=lambda k: len(urlencode({k: list(params[k])}, doseq=True)))
+    base = {k: v for k, v in params.items() if k != key}
+    budget = max_length - len(urlencode(base, doseq=True)) - 1
+    chunks = []
+    chunk = []
+    length = 0
+    for value in params[key]:
+        size = len(urlencode({key: value})) + 1
+        if chunk and length + size > budget:
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        chunk.append(value)
+        length += size
+    chunks.append(chunk)
+    result = []
+    for chunk in chunks:
+        result.extend(_split_params({**base, key: chunk}, max_length))
+    return result
 
 
 class Lims:
@@ -64,19 +154,56 @@ class Lims:
 
     VERSION = "v2"
 
-    def __init__(self, baseuri, username, password, version=VERSION):
+    def __init__(
+        self,
+        baseuri,
+        username,
+        password,
+        version=VERSION,
+        batch_on_miss=None,
+        artifact_states=False,
+        query_cache=None,
+        backing_store=None,
+    ):
         """baseuri: Base URI for the GenoLogics server, excluding
                     the 'api' or version parts!
                     For example: https://genologics.scilifelab.se:8443/
         username: The account name of the user to login as.
         password: The password for the user account to login as.
         version: The optional LIMS API version, by default 'v2'
+        batch_on_miss: Optional window size. When set, the first access to
+                    an unloaded entity that came from a list (query results,
+                    placements, process inputs or outputs...) loads it
+                    together with the other entities of its window, the
+                    list being cut into windows of that many entities,
+                    with a batch call where available.
+        artifact_states: If True, artifact URIs differing by their state
+                    (?state=...) give separate entities, each one loading
+                    the artifact as it was at that state. By default, they
+                    give the same entity, loaded at its current state; use
+                    Artifact.at_state() for an artifact at a given state.
+        query_cache: Optional genologics.query.QueryCache, in which the
+                    results of the get_* list queries are kept for reuse.
+        backing_store: Optional read-only store of entity XML, such as a
+                    genologics.archive.ArchiveReader, from which the
+                    entities it holds are loaded instead of the LIMS.
         """
         self.baseuri = baseuri.rstrip("/") + "/"
         self.username = username
         self.password = password
         self.VERSION = version
+        self.batch_on_miss = batch_on_miss
+        self.artifact_states = artifact_states
+        self.query_cache = query_cache
+        self.backing_store = backing_store
         self.cache = dict()
+        # Active UnitOfWork of each thread, see _unit_of_work
+        self._local = threading.local()
+        # URIs of the entities invalidated since the last refresh_stale()
+        self.stale = set()
+        # Entity -> _SiblingWindow, for batch_on_miss
+        self._windows = weakref.WeakKeyDictionary()
+        self._windows_lock = threading.Lock()
         # For optimization purposes, enables requests to persist connections
         self.request_session = requests.Session()
         # The connection pool has a default size of 10
@@ -84,6 +211,7 @@ class Lims:
             pool_connections=100, pool_maxsize=100
         )
         self.request_session.mount("http://", self.adapter)
+        self.request_session.mount("https://", self.adapter)
 
     def get_uri(self, *segments, **query):
         "Return the full URI given the path segments and optional query."
@@ -153,7 +281,7 @@ class Lims:
 
         # Actually upload the file
         uri = self.get_uri("files", file.id, "upload")
-        r = requests.post(
+        r = self.request_session.post(
             uri,
             files={"file": (file_to_upload, open(file_to_upload, "rb"))},
             auth=(self.username, self.password),
@@ -165,12 +293,13 @@ class Lims:
         """PUT the serialized XML to the given URI.
         Return the response XML as an ElementTree.
         """
-        r = requests.put(
+        r = self.request_session.put(
             uri,
             data=data,
             params=params,
             auth=(self.username, self.password),
             headers={"content-type": "application/xml", "accept": "application/xml"},
+            timeout=TIMEOUT,
         )
         return self.parse_response(r)
 
@@ -178,12 +307,13 @@ class Lims:
         """POST the serialized XML to the given URI.
         Return the response XML as an ElementTree.
         """
-        r = requests.post(
+        r = self.request_session.post(
             uri,
             data=data,
             params=params,
             auth=(self.username, self.password),
             headers={"content-type": "application/xml", "accept": "application/xml"},
+            timeout=TIMEOUT,
         )
         return self.parse_response(r, accept_status_codes=[200, 201, 202])
 
@@ -191,11 +321,12 @@ class Lims:
         """sends a DELETE to the given URI.
         Return the response XML as an ElementTree.
         """
-        r = requests.delete(
+        r = self.request_session.delete(
             uri,
             params=params,
             auth=(self.username, self.password),
             headers={"content-type": "application/xml", "accept": "application/xml"},
+            timeout=TIMEOUT,
         )
         return self.validate_response(r, accept_status_codes=[204])
 
@@ -384,15 +515,7 @@ class Lims:
             start_index=start_index,
         )
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        root = self.get(self.get_uri(Sample._URI), params=params)
-        total = 0
-        while params.get("start-index") is None:  # Loop over all pages.
-            total += len(root.findall("sample"))
-            node = root.find("next-page")
-            if node is None:
-                break
-            root = self.get(node.attrib["uri"], params=params)
-        return total
+        return Query(self, Sample, params).count()
 
     def get_samples(
         self,
@@ -479,10 +602,54 @@ class Lims:
         )
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
         if resolve:
-            return self.get_batch(self._get_instances(Artifact, params=params))
+            if self.query_cache is None:
+                pages = self._iter_instances(Artifact, params)
+                return list(self._iter_resolved(pages))
+            instances = self._get_instances(Artifact, params=params)
+            _raise_first(self._load_entities(instances))
+            return instances
         else:
             return self._get_instances(Artifact, params=params)
 
+    def processes_by_input(self, artifacts, type=None, max_workers=MAX_WORKERS):
+        """Return a dictionary of each given artifact -> the list of processes
+        using it as input, optionally only of the given process type(s).
+        The processes are found with multi-value queries and loaded with
+        concurrent GETs."""
+        artifacts = list(artifacts)
+        by_id = {artifact.id: artifact for artifact in artifacts}
+        result = {artifact: [] for artifact in artifacts}
+        if not artifacts:
+            return result
+        processes = self.get_processes(inputartifactlimsid=list(by_id), type=type)
+        _raise_first(self._load_entities(processes, max_workers))
+        for process in processes:
+            for input_id in process.input_output_index.input_ids():
+                artifact = by_id.get(input_id)
+                if artifact is not None and process not in result[artifact]:
+                    result[artifact].append(process)
+        return result
+
+    def artifacts_by_sample(self, samples, type=None):
+        """Return a dictionary of each given sample -> the list of artifacts
+        derived from it, optionally only of the given artifact type(s).
+        The artifacts are found with multi-value queries and loaded with
+        batch calls."""
+        samples = list(samples)
+        by_id = {sample.id: sample for sample in samples}
+        result = {sample: [] for sample in samples}
+        if not samples:
+            return result
+        artifacts = self.get_artifacts(
+            samplelimsid=list(by_id), type=type, resolve=True
+        )
+        for artifact in artifacts:
+            for sample in artifact.samples:
+                sample = by_id.get(sample.id)
+                if sample is not None and artifact not in result[sample]:
+                    result[sample].append(artifact)
+        return result
+
     def get_container_types(self, name=None, start_index=None):
         """Get a list of container types, filtered by keyword arguments.
         name: Container Type name.
@@ -626,31 +793,343 @@ class Lims:
             result[f"udt.{key}"] = value
         return result
 
-    def _get_instances(self, klass, add_info=None, params=dict()):
-        results = []
-        additionnal_info_dicts = []
+    def _iter_nodes(self, klass, params):
+        """Yield the list of entity nodes of each page of a list query.
+        Pages are fetched one at a time, as the iteration proceeds; if
+        start-index is given, only that page is fetched. Queries too long
+        for a URL are run as several ones, without repeating entities."""
         tag = klass._TAG
         if tag is None:
             tag = klass.__name__.lower()
-        root = self.get(self.get_uri(klass._URI), params=params)
-        while params.get("start-index") is None:  # Loop over all pages.
-            for node in root.findall(tag):
-                results.append(klass(self, uri=node.attrib["uri"]))
-                info_dict = {}
-                for attrib_key in node.attrib:
-                    info_dict[attrib_key] = node.attrib["uri"]
-                for subnode in node:
-                    info_dict[subnode.tag] = subnode.text
-                additionnal_info_dicts.append(info_dict)
-            node = root.find("next-page")
-            if node is None:
-                break
-            root = self.get(node.attrib["uri"], params=params)
+        chunks = _split_params(params)
+        seen = set()
+        for chunk in chunks:
+            root = self.get(self.get_uri(klass._URI), params=chunk)
+            while True:
+                nodes = root.findall(tag)
+                if len(chunks) > 1:
+                    nodes = self._unseen_nodes(klass, nodes, seen)
+                yield nodes
+                if chunk.get("start-index") is not None:
+                    break
+                node = root.find("next-page")
+                if node is None:
+                    break
+                # The next-page URI carries the filters already
+                root = self.get(node.attrib["uri"])
+
+    def _unseen_nodes(self, klass, nodes, seen):
+        "Return the nodes of entities not in seen, adding them to it."
+        result = []
+        for node in nodes:
+            uri = klass._canonical_uri(self, node.attrib["uri"])
+            if uri not in seen:
+                seen.add(uri)
+                result.append(node)
+        return result
+
+    def _iter_instances(self, klass, params, info_dicts=None):
+        """Yield the list of entities of each page of a list query.
+        If info_dicts is a list, the attributes and subnode texts of
+        each entity node are appended to it."""
+        for nodes in self._iter_nodes(klass, params):
+            instances = []
+            for node in nodes:
+                instance = klass(self, uri=node.attrib["uri"])
+                if instance.root is None:
+                    # Serve the fields of the list page until the full XML is needed
+                    instance._summary = node
+                instances.append(instance)
+                if info_dicts is not None:
+                    info_dict = dict(node.attrib)
+                    for subnode in node:
+                        info_dict[subnode.tag] = subnode.text
+                    info_dicts.append(info_dict)
+            self._register_siblings(instances)
+            yield instances
+
+    def _get_instances(self, klass, add_info=None, params=dict()):
+        if self.query_cache is None:
+            results, additionnal_info_dicts = self._fetch_instances(klass, params)
+        else:
+            key = self.query_cache.key(klass, params)
+            cached = self.query_cache.get(key)
+            if cached is None:
+                cached = self._fetch_instances(klass, params)
+                self.query_cache.set(key, cached)
+            results, additionnal_info_dicts = list(cached[0]), list(cached[1])
         if add_info:
             return results, additionnal_info_dicts
         else:
             return results
 
+    def _fetch_instances(self, klass, params):
+        """Run a list query; return the list of entities and the list of
+        dictionaries of the attributes and subnode texts of their nodes."""
+        results = []
+        additionnal_info_dicts = []
+        chunks = _split_params(params)
+        if len(chunks) == 1:
+            for instances in self._iter_instances(
+                klass, params, info_dicts=additionnal_info_dicts
+            ):
+                results.extend(instances)
+        else:
+            # Run the sub-queries concurrently, then merge them in order
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                parts = executor.map(
+                    lambda chunk: self._fetch_instances(klass, chunk), chunks
+                )
+                seen = set()
+                for instances, info_dicts in parts:
+                    for instance, info_dict in zip(instances, info_dicts):
+                        if instance.uri not in seen:
+                            seen.add(instance.uri)
+                            results.append(instance)
+                            additionnal_info_dicts.append(info_dict)
+        return results, additionnal_info_dicts
+
+    def _iter_resolved(self, pages, max_workers=None):
+        """Yield the entities of the given pages, lists of entities such as
+        from _iter_instances, with their XML loaded. The batch calls and GETs
+        of all pages share one pool of max_workers, MAX_WORKERS by default,
+        so that a page is loaded while the next ones are fetched, and the
+        entities are yielded in order, without duplicates, as their page is
+        loaded."""
+        if max_workers is None:
+            max_workers = MAX_WORKERS
+        pending = deque()
+        seen = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for instances in pages:
+                page = []
+                for instance in instances:
+                    if instance.uri not in seen:
+                        seen.add(instance.uri)
+                        page.append(instance)
+                pending.append((self._submit_loads(executor, page), page))
+                while pending and (
+                    all(future.done() for future, _ in pending[0][0])
+                    or len(pending) > 2 * max_workers
+                ):
+                    tasks, page = pending.popleft()
+                    _raise_first(_task_failures(tasks))
+                    yield from page
+            while pending:
+                tasks, page = pending.popleft()
+                _raise_first(_task_failures(tasks))
+                yield from page
+
+    def _count(self, klass, params, max_workers=None):
+        """Return the number of entities matching a list query, counting
+        the nodes of each page and discarding it. Once the first page gives
+        the page size, the following pages are fetched max_workers at a
+        time, MAX_WORKERS by default."""
+        if max_workers is None:
+            max_workers = MAX_WORKERS
+        total, pages = self._count_first(klass, params)
+        if pages is None:
+            return total
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return total + self._count_pages(executor, pages, max_workers)
+
+    def _count_first(self, klass, params):
+        """Count the entities of the first page of a list query. Return the
+        count and, when the following pages can be fetched by start-index,
+        the (uri, params, tag, page size) to pass to _count_pages, or None
+        if the count is complete. Queries whose pages cannot be addressed
+        that way are counted here, following their pages one by one."""
+        if params.get("start-index") is not None or len(_split_params(params)) > 1:
+            return sum(len(nodes) for nodes in self._iter_nodes(klass, params)), None
+        tag = klass._TAG
+        if tag is None:
+            tag = klass.__name__.lower()
+        uri = self.get_uri(klass._URI)
+        root = self.get(uri, params=params)
+        total = len(root.findall(tag))
+        node = root.find("next-page")
+        if node is None:
+            return total, None
+        try:
+            query = parse_qs(urlparse(node.attrib["uri"]).query)
+            stride = int(query["start-index"][0])
+        except (KeyError, IndexError, ValueError):
+            # Unknown page size, follow the pages one by one
+            while node is not None:
+                root = self.get(node.attrib["uri"])
+                total += len(root.findall(tag))
+                node = root.find("next-page")
+            return total, None
+        return total, (uri, params, tag, stride)
+
+    def _count_pages(self, executor, pages, max_workers):
+        """Return the number of entities of the pages following the first
+        one, as described by _count_first, fetched on the executor in
+        windows of 1, 2, 4... pages, up to max_workers, so that small
+        results take few requests. No page is requested once the last
+        one has arrived."""
+        uri, params, tag, stride = pages
+        # Set once a page without a next page, the last one, has arrived
+        last = threading.Event()
+
+        def count_page(index):
+            root = self.get(uri, params={**params, "start-index": index})
+            has_next = root.find("next-page") is not None
+            if not has_next:
+                last.set()
+            return len(root.findall(tag)), has_next
+
+        total = 0
+        index = stride
+        window = 1
+        while True:
+            futures = []
+            while len(futures) < window and not last.is_set():
+                futures.append(executor.submit(count_page, index))
+                index += stride
+            for future in futures:
+                count, has_next = future.result()
+                total += count
+                if not has_next:
+                    for pending in futures:
+                        pending.cancel()
+                    return total
+            window = min(window * 2, max_workers)
+
+    def _iter_page_roots(self, root, max_workers=None):
+        """Yield root, the loaded first page of a paginated resource, then
+        the XML of the following pages, without creating entities for them.
+        When the next-page URI gives the page size by its start-index, up
+        to max_workers pages, MAX_WORKERS by default, are fetched ahead
+        concurrently, until the last page has arrived; otherwise the pages
+        are followed one by one. Pages fetched ahead are dropped when the
+        iteration is stopped."""
+        if max_workers is None:
+            max_workers = MAX_WORKERS
+        yield root
+        node = root.find("next-page")
+        if node is None:
+            return
+        parsed = urlparse(node.attrib["uri"])
+        query = parse_qs(parsed.query)
+        try:
+            stride = int(query.pop("start-index")[0])
+        except (KeyError, IndexError, ValueError):
+            while node is not None:
+                root = self.get(node.attrib["uri"])
+                yield root
+                node = root.find("next-page")
+            return
+        uri = parsed._replace(query="").geturl()
+
+        # Set once a page without a next page, the last one, has arrived
+        last = threading.Event()
+
+        def get_page(index):
+            root = self.get(uri, params={**query, "start-index": index})
+            if root.find("next-page") is None:
+                last.set()
+            return root
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        pending = deque()
+        index = stride
+        try:
+            while True:
+                while len(pending) < max_workers and not last.is_set():
+                    pending.append(executor.submit(get_page, index))
+                    index += stride
+                root = pending.popleft().result()
+                yield root
+                if root.find("next-page") is None:
+                    return
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def count_samples(self, max_workers=MAX_WORKERS, **filters):
+        "Return the number of samples matching the filters of get_samples."
+        return self.samples.filter(**filters).count(max_workers=max_workers)
+
+    def count_artifacts(self, max_workers=MAX_WORKERS, **filters):
+        "Return the number of artifacts matching the filters of get_artifacts."
+        return self.artifacts.filter(**filters).count(max_workers=max_workers)
+
+    def count_processes(self, max_workers=MAX_WORKERS, **filters):
+        "Return the number of processes matching the filters of get_processes."
+        return self.processes.filter(**filters).count(max_workers=max_workers)
+
+    def count_containers(self, max_workers=MAX_WORKERS, **filters):
+        "Return the number of containers matching the filters of get_containers."
+        return self.containers.filter(**filters).count(max_workers=max_workers)
+
+    def count_projects(self, max_workers=MAX_WORKERS, **filters):
+        "Return the number of projects matching the filters of get_projects."
+        return self.projects.filter(**filters).count(max_workers=max_workers)
+
+    def count_many(self, queries, max_workers=MAX_WORKERS):
+        """Return the counts of the given Query objects, run in parallel.
+        For example, the number of samples of each project:
+        lims.count_many(lims.samples.filter(projectlimsid=p.id) for p in projects)
+        """
+        queries = list(queries)
+        if not queries:
+            return []
+
+        def count_first(query):
+            if query._limit is not None:
+                # Counted page by page, without a pool of its own
+                return query.count(), None
+            return self._count_first(query.klass, query.params)
+
+        # The first pages of all queries, then the following pages of each,
+        # are fetched on the same pool, rather than a pool per query
+        counts = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for total, pages in list(executor.map(count_first, queries)):
+                if pages is not None:
+                    total += self._count_pages(executor, pages, max_workers)
+                counts.append(total)
+        return counts
+
+    def query(self, klass):
+        "Return a lazy Query of the entities of the given class."
+        return Query(self, klass)
+
+    @property
+    def artifacts(self):
+        "Lazy query of artifacts; see get_artifacts for the filters."
+        return Query(self, Artifact)
+
+    @property
+    def samples(self):
+        "Lazy query of samples; see get_samples for the filters."
+        return Query(self, Sample)
+
+    @property
+    def processes(self):
+        "Lazy query of processes; see get_processes for the filters."
+        return Query(self, Process)
+
+    @property
+    def containers(self):
+        "Lazy query of containers; see get_containers for the filters."
+        return Query(self, Container)
+
+    @property
+    def projects(self):
+        "Lazy query of projects; see get_projects for the filters."
+        return Query(self, Project)
+
+    @property
+    def researchers(self):
+        "Lazy query of researchers; see get_researchers for the filters."
+        return Query(self, Researcher)
+
+    @property
+    def labs(self):
+        "Lazy query of labs; see get_labs for the filters."
+        return Query(self, Lab)
+
     def get_batch(self, instances, force=False):
         """Get the content of a set of instances using the efficient batch call.
 
@@ -665,13 +1144,13 @@ class Lims:
 
         The batch request API call collapses all requested Artifacts with different
         state into a single result with state equal to the state of the Artifact
-        occurring at the last position in the list.
+        occurring at the last position in the list. Unless artifact_states is
+        set, such Artifacts are a single entity anyway.
         """
         if not instances:
             return []
 
-        ALLOWED_TAGS = ("artifact", "container", "file", "sample")
-        if instances[0]._TAG not in ALLOWED_TAGS:
+        if instances[0]._TAG not in BATCH_TAGS:
             raise TypeError(
                 f"Cannot retrieve batch for instances of type '{instances[0]._TAG}'"
             )
@@ -693,17 +1172,308 @@ class Lims:
             root = self.post(uri, data)
             for node in list(root):
                 instance = instance_map[node.attrib["limsid"]]
-                instance.root = node
+                instance._set_loaded(node)
         return list(instance_map.values())
 
-    def put_batch(self, instances):
-        """Update multiple instances using a single batch request."""
+    def prefetch(self, entities, *paths, max_workers=MAX_WORKERS):
+        """Load the given entities and the entities they reference along the
+        given dotted attribute paths, one relationship level at a time.
+
+        For example, prefetch(artifacts, "samples.project", "container")
+        loads the artifacts, then all their samples, then all the projects
+        of these samples, and all the containers of the artifacts, with
+        batch calls where available and concurrent GETs otherwise.
+        Returns the list of given entities.
+        """
+        entities = list(entities)
+        _raise_first(self._load_entities(entities, max_workers))
+        for path in paths:
+            level = entities
+            for attribute in path.split("."):
+                related = dict()
+                for entity in level:
+                    value = getattr(entity, attribute)
+                    if not isinstance(value, (list, tuple)):
+                        value = [value]
+                    for item in value:
+                        if isinstance(item, Entity):
+                            related[item.uri] = item
+                level = list(related.values())
+                _raise_first(self._load_entities(level, max_workers))
+        return entities
+
+    def _load_entities(self, entities, max_workers=MAX_WORKERS, force=False):
+        """Load the XML of the entities not loaded yet: by chunked batch
+        calls for the types supporting it, by concurrent GETs for others.
+        With force, all the entities are loaded again from the LIMS,
+        bypassing the backing store and the batch_on_miss windows.
+        Return a dictionary of the entities that could not be loaded,
+        mapped to the exception raised for each of them."""
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tasks = self._submit_loads(executor, entities, force)
+        return _task_failures(tasks)
+
+    def _submit_loads(self, executor, entities, force=False):
+        """Submit to the executor the loading of the entities not loaded
+        yet, or of all of them with force, a get_batch call per chunk of a
+        type supporting it and a GET per other entity, without waiting for
+        them. Return the list of (future, entities loaded by it) pairs, for
+        _task_failures."""
+        by_class = dict()
+        for entity in entities:
+            if not force and entity.root is None and self.backing_store is not None:
+                entity._load_stored()
+            if force or entity.root is None:
+                by_class.setdefault(entity.__class__, dict())[entity.uri] = entity
+        tasks = []
+        for klass, instances in by_class.items():
+            instances = list(instances.values())
+            if klass._TAG in BATCH_TAGS:
+                for i in range(0, len(instances), BATCH_SIZE):
+                    batch = instances[i : i + BATCH_SIZE]
+                    future = executor.submit(self.get_batch, batch, force=force)
+                    tasks.append((future, batch))
+            else:
+                for entity in instances:
+                    future = executor.submit(entity.get, force=force)
+                    tasks.append((future, [entity]))
+        return tasks
+
+    def _register_siblings(self, entities):
+        """Remember that the given entities were obtained together, so that
+        they can be loaded as a group when batch_on_miss is enabled. The
+        unloaded entities of each class are cut into windows of
+        batch_on_miss entities, held by weak references."""
+        if not self.batch_on_miss:
+            return
+        by_class = dict()
+        for entity in entities:
+            if isinstance(entity, Entity) and entity.root is None:
+                by_class.setdefault(entity.__class__, []).append(entity)
+        with self._windows_lock:
+            for instances in by_class.values():
+                for i in range(0, len(instances), self.batch_on_miss):
+                    window = _SiblingWindow(instances[i : i + self.batch_on_miss])
+                    for entity in window.members():
+                        self._windows[entity] = window
+
+    def _get_siblings(self, entity):
+        """Load the entity together with the other unloaded entities of its
+        window, if it has one. A window is loaded once: other threads
+        reaching it meanwhile wait for that load instead of repeating it."""
+        with self._windows_lock:
+            window = self._windows.get(entity)
+            if window is None:
+                return
+            loading = window.claimed
+            window.claimed = True
+        if loading:
+            window.done.wait()
+            return
+        try:
+            members = [e for e in window.members() if e.root is None]
+            if self.backing_store is not None:
+                members = [e for e in members if not e._load_stored()]
+            _raise_first(self._load_entities(members, force=True))
+        finally:
+            with self._windows_lock:
+                for member in window.members():
+                    self._windows.pop(member, None)
+            window.done.set()
+
+    def get_many(self, entities, max_workers=MAX_WORKERS, force=False):
+        """Get the content of entities of any type with concurrent GETs
+        over the pooled session. Use get_batch where it is available.
+
+        Entities already loaded are skipped, unless force is True.
+        Returns a dictionary of the entities that could not be retrieved,
+        mapped to the exception raised for each of them.
+        """
+        todo = dict()
+        for entity in entities:
+            if force or entity.root is None:
+                todo[entity.uri] = entity
+        failures = dict()
+        if not todo:
+            return failures
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(entity.get, force=force): entity
+                for entity in todo.values()
+            }
+            for future, entity in futures.items():
+                error = future.exception()
+                if error is not None:
+                    failures[entity] = error
+        return failures
+
+    @property
+    def _unit_of_work(self):
+        """The UnitOfWork active in the current thread, collecting changed
+        entities instead of saving them, or None. Other threads using the
+        same Lims are not affected by it."""
+        return getattr(self._local, "unit_of_work", None)
+
+    @_unit_of_work.setter
+    def _unit_of_work(self, unit):
+        self._local.unit_of_work = unit
+
+    def unit_of_work(self, max_workers=MAX_WORKERS):
+        """Return a context manager deferring the saving of changed entities.
+
+        with lims.unit_of_work() as unit:
+            for artifact in artifacts:
+                artifact.udf["Conc"] = 1.0
+        for entity, error in unit.failures.items():
+            ...
+
+        Entities changed through their descriptors, or put(), within the
+        block are saved when it exits: with chunked batch updates for the
+        types supporting them, with concurrent PUTs for others. Only the
+        changes made by the thread running the block are collected.
+        """
+        return UnitOfWork(self, max_workers=max_workers)
+
+    def invalidate(self, entities):
+        """Mark cached entities as stale after a change made on the server
+        side: their XML is dropped, to be loaded again on next access or by
+        refresh_stale(). Entities with unsaved changes are left as they are.
+        The cached query results on their classes are dropped too, as they
+        may differ.
+        """
+        entities = list(entities)
+        self._written(entity.__class__ for entity in entities if entity is not None)
+        for entity in entities:
+            if entity is None:
+                continue
+            entity = self.cache.get(entity.uri, entity)
+            if entity.root is None and entity._summary is None:
+                continue
+            if entity._clean_digest is not None and entity.is_modified():
+                logger.warning(f"Not invalidating {entity}, it has unsaved changes")
+                continue
+            entity.root = None
+            entity._summary = None
+            self.stale.add(entity.uri)
 
+    def _written(self, classes):
+        "Drop the cached query results on the given entity classes, if any."
+        if self.query_cache is None:
+            return
+        for klass in set(classes):
+            self.query_cache.invalidate(klass)
+
+    def refresh_stale(self, max_workers=MAX_WORKERS):
+        """Load again the entities invalidated since the last call and not
+        loaded since, with batch calls where available. Return a dictionary
+        of the entities that could not be loaded, mapped to their error."""
+        stale = [self.cache[uri] for uri in self.stale if uri in self.cache]
+        self.stale = set()
+        return self._load_entities(stale, max_workers)
+
+    def update_udfs(
+        self,
+        updates=None,
+        entities=None,
+        names=None,
+        values=None,
+        max_workers=MAX_WORKERS,
+    ):
+        """Set UDF values on many entities and save them in bulk.
+
+        updates: dictionary of entity -> {UDF name: value}.
+        Alternatively, by columns: entities, the list of entities, names,
+        the list of UDF names, and values, one list of values per name,
+        holding the value for each entity in the same order.
+
+        Entities not loaded yet are loaded with chunked batch calls.
+        The type of each UDF is looked up once, from the entities already
+        having it, or else guessed from the values, and each value is
+        checked against it. Entities with any value not suiting the type
+        are left unchanged. The changed entities are then saved as in
+        unit_of_work(); within an active unit of work, they are left to it.
+
+        The UDFs are set through the udf dictionary of each entity, so they
+        are written where the entity keeps them.
+
+        Return a dictionary of entity -> None when updated, or the
+        exception raised when loading, converting or saving it. Within an
+        active unit of work, None only means that the entity was changed:
+        it is saved, and its errors reported, when the unit is flushed.
+        """
+        columns = dict()
+        if updates is not None:
+            for entity, udfs in updates.items():
+                for name, value in udfs.items():
+                    columns.setdefault(name, []).append((entity, value))
+        else:
+            for name, column in zip(names, values):
+                if len(column) != len(entities):
+                    raise ValueError(f"Expected {len(entities)} values for '{name}'")
+                columns.setdefault(name, []).extend(zip(entities, column))
+        outcomes = dict()
+        for column in columns.values():
+            for entity, value in column:
+                outcomes[entity] = None
+        outcomes.update(self._load_entities(list(outcomes), max_workers))
+
+        udfs = dict()
+        for entity, outcome in outcomes.items():
+            if outcome is None:
+                try:
+                    udfs[entity] = entity.udf
+                except AttributeError as e:
+                    outcomes[entity] = e
+        values = dict()
+        for name, column in columns.items():
+            vtype = None
+            for entity, value in column:
+                if entity in udfs:
+                    vtype = udfs[entity].get_type(name)
+                    if vtype is not None:
+                        break
+            if vtype is None:
+                for entity, value in column:
+                    if value is not None:
+                        vtype = udf_type(value)
+                        break
+            for entity, value in column:
+                if entity not in udfs:
+                    continue
+                try:
+                    if vtype is None:
+                        raise TypeError(f"Cannot tell the type of UDF '{name}'")
+                    udf_text(udfs[entity].get_type(name) or vtype, value)
+                    values.setdefault(entity, []).append((name, vtype, value))
+                except (TypeError, NotImplementedError) as e:
+                    outcomes[entity] = e
+
+        changed = []
+        for entity, entity_values in values.items():
+            if outcomes[entity] is not None:
+                continue
+            for name, vtype, value in entity_values:
+                udfs[entity].set(name, value, vtype)
+            changed.append(entity)
+
+        if self._unit_of_work is None:
+            unit = self.unit_of_work(max_workers=max_workers)
+            for entity in changed:
+                unit.add(entity)
+            outcomes.update(unit.flush())
+        return outcomes
+
+    def put_batch(self, instances, force=False):
+        """Update multiple instances using a single batch request.
+        Instances whose XML is unchanged since loading are left out,
+        unless force is True."""
+
+        if not force:
+            instances = [i for i in instances if i.is_modified()]
         if not instances:
             return
 
-        ALLOWED_TAGS = ("artifact", "container", "file", "sample")
-        if instances[0]._TAG not in ALLOWED_TAGS:
+        if instances[0]._TAG not in BATCH_TAGS:
             raise TypeError(
                 f"Cannot update batch for instances of type '{instances[0]._TAG}'"
             )
@@ -723,6 +1493,9 @@ class Lims:
         uri = self.get_uri(klass._URI, "batch/update")
         data = self.tostring(ElementTree.ElementTree(root))
         root = self.post(uri, data)
+        for instance in instances:
+            instance._clean_digest = instance._digest()
+        self._written(instance.__class__ for instance in instances)
 
     def route_artifacts(
         self, artifact_list, workflow_uri=None, stage_uri=None, unassign=False
@@ -741,13 +1514,17 @@ class Lims:
             a.set("uri", artifact.uri)
 
         uri = self.get_uri("route", "artifacts")
-        r = requests.post(
+        r = self.request_session.post(
             uri,
             data=self.tostring(ElementTree.ElementTree(root)),
             auth=(self.username, self.password),
             headers={"content-type": "application/xml", "accept": "application/xml"},
+            timeout=TIMEOUT,
         )
         self.validate_response(r)
+        # The workflow stages of the artifacts and the queues have changed
+        queues = [e for e in list(self.cache.values()) if isinstance(e, Queue)]
+        self.invalidate(list(artifact_list) + queues)
 
     def tostring(self, etree):
         "Return the ElementTree contents as a UTF-8 encoded XML string."
@@ -777,3 +1554,85 @@ class Lims:
         ret_con.root = ret_el
 
         return ret_con
+
+
+class UnitOfWork:
+    """Collects the entities changed while it is active and saves them in
+    bulk when flushed. Use through Lims.unit_of_work().
+
+    failures: entities that could not be saved, mapped to the exception
+    raised for each of them.
+    """
+
+    def __init__(self, lims, max_workers=MAX_WORKERS):
+        self.lims = lims
+        self.max_workers = max_workers
+        self.entities = dict()
+        self.forced = set()
+        self.failures = dict()
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = self.lims._unit_of_work
+        self.lims._unit_of_work = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lims._unit_of_work = self._previous
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    def add(self, entity, force=False):
+        "Register an entity to be saved; with force, even if unchanged."
+        if entity.uri is None:
+            # Not created in the LIMS yet
+            return
+        self.entities[entity.uri] = entity
+        if force:
+            self.forced.add(entity.uri)
+
+    def discard(self):
+        "Forget the registered entities without saving them."
+        self.entities = dict()
+        self.forced = set()
+
+    def flush(self):
+        """Save the registered entities that were changed. Return the
+        dictionary of the ones that failed, also added to failures."""
+        batches = []
+        singles = []
+        by_class = dict()
+        for uri, entity in self.entities.items():
+            if uri in self.forced or entity.is_modified():
+                by_class.setdefault(entity.__class__, []).append(entity)
+        self.discard()
+        for klass, instances in by_class.items():
+            if klass._TAG in BATCH_TAGS:
+                for i in range(0, len(instances), BATCH_SIZE):
+                    batches.append(instances[i : i + BATCH_SIZE])
+            else:
+                singles.extend(instances)
+        failures = dict()
+        if not batches and not singles:
+            return failures
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                (executor.submit(self.lims.put_batch, batch, force=True), batch)
+                for batch in batches
+            ]
+            futures.extend(
+                (executor.submit(entity._put, force=True), [entity])
+                for entity in singles
+            )
+            for future, instances in futures:
+                error = future.exception()
+                if error is not None:
+                    for entity in instances:
+                        failures[entity] = error
+        for entity, error in failures.items():
+            logger.warning(f"Could not save {entity}: {error}")
+        self.failures.update(failures)
+        return failures
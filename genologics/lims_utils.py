@@ -17,9 +17,14 @@ def get_run_info(fc):
     return fc_summary
 
 
-def procHistory(proc, samplename):
+def procHistory(proc, samplename, genealogy=None):
     """Quick way to get the ids of parent processes from the given process,
-    while staying in a sample scope"""
+    while staying in a sample scope.
+    If a genologics.genealogy.Genealogy is given, it is used instead of
+    querying the lims."""
+    if genealogy is not None:
+        starting_art = proc.input_per_sample(samplename)[0].id
+        return genealogy.process_history(starting_art, samplename)
     hist = []
     artifacts = lims.get_artifacts(sample_name=samplename, type="Analyte")
     not_done = True
@@ -0,0 +1,320 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Local SQLite mirror of LIMS entities, for offline queries.
+
+The XML of the mirrored samples, artifacts, processes and containers is
+kept in the database, together with indexed tables of their main fields,
+their relations (artifact samples, process inputs and outputs, container
+placements) and their UDFs:
+
+    mirror = SqliteMirror(lims, "mirror.sqlite")
+    mirror.load_project(project)
+    mirror.samples_by_udf("Conc", ">", 5, project_id=project.id)
+    mirror.artifacts_in_container("27-1234")
+    mirror.rows("SELECT type, count(*) FROM artifacts GROUP BY type")
+
+Entities returned by the query helpers get their XML from the mirror, so
+reading their fields does not query the LIMS. The mirror also implements
+the store interface of genologics.sync.DeltaSync.
+"""
+
+import logging
+import sqlite3
+from xml.etree import ElementTree
+
+from genologics.constants import nsmap
+from genologics.entities import Artifact, Container, Process, Sample
+from genologics.genealogy import load_lineage
+from genologics.lims import MAX_WORKERS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    kind TEXT, id TEXT, xml BLOB, PRIMARY KEY (kind, id));
+CREATE TABLE IF NOT EXISTS samples (
+    id TEXT PRIMARY KEY, name TEXT, project_id TEXT, date_received TEXT);
+CREATE INDEX IF NOT EXISTS samples_name ON samples (name);
+CREATE INDEX IF NOT EXISTS samples_project ON samples (project_id);
+CREATE TABLE IF NOT EXISTS artifacts (
+    id TEXT PRIMARY KEY, name TEXT, type TEXT, qc_flag TEXT,
+    parent_process_id TEXT);
+CREATE INDEX IF NOT EXISTS artifacts_type ON artifacts (type);
+CREATE INDEX IF NOT EXISTS artifacts_parent ON artifacts (parent_process_id);
+CREATE TABLE IF NOT EXISTS artifact_samples (
+    artifact_id TEXT, sample_id TEXT, PRIMARY KEY (artifact_id, sample_id));
+CREATE INDEX IF NOT EXISTS artifact_samples_sample
+    ON artifact_samples (sample_id);
+CREATE TABLE IF NOT EXISTS processes (
+    id TEXT PRIMARY KEY, type_name TEXT, date_run TEXT);
+CREATE INDEX IF NOT EXISTS processes_type ON processes (type_name);
+CREATE TABLE IF NOT EXISTS process_io (
+    process_id TEXT, input_id TEXT, output_id TEXT, output_type TEXT);
+CREATE INDEX IF NOT EXISTS process_io_process ON process_io (process_id);
+CREATE INDEX IF NOT EXISTS process_io_input ON process_io (input_id);
+CREATE INDEX IF NOT EXISTS process_io_output ON process_io (output_id);
+CREATE TABLE IF NOT EXISTS containers (
+    id TEXT PRIMARY KEY, name TEXT, type_name TEXT, state TEXT);
+CREATE INDEX IF NOT EXISTS containers_name ON containers (name);
+CREATE TABLE IF NOT EXISTS placements (
+    container_id TEXT, well TEXT, artifact_id TEXT,
+    PRIMARY KEY (container_id, well));
+CREATE INDEX IF NOT EXISTS placements_artifact ON placements (artifact_id);
+CREATE TABLE IF NOT EXISTS udfs (
+    kind TEXT, entity_id TEXT, name TEXT, type TEXT, value TEXT, number REAL,
+    PRIMARY KEY (kind, entity_id, name));
+CREATE INDEX IF NOT EXISTS udfs_number ON udfs (kind, name, number);
+CREATE INDEX IF NOT EXISTS udfs_value ON udfs (kind, name, value);
+CREATE TABLE IF NOT EXISTS marks (name TEXT PRIMARY KEY, mark TEXT);
+"""
+
+# Comparison operators accepted by the query helpers
+OPERATORS = ("=", "!=", "<", "<=", ">", ">=")
+
+
+def _id(node):
+    "Return the LIMS id of an entity link node."
+    if node is None:
+        return None
+    limsid = node.attrib.get("limsid")
+    if limsid is None:
+        limsid = node.attrib["uri"].split("?")[0].split("/")[-1]
+    return limsid
+
+
+def _text(node, tag):
+    child = node.find(tag)
+    if child is None:
+        return None
+    return child.text
+
+
+class SqliteMirror:
+    "Mirror of LIMS entities in a SQLite database, by default in memory."
+
+    def __init__(self, lims, path=":memory:"):
+        self.lims = lims
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, entities):
+        """Store loaded entities, replacing their previous version.
+        Entities of types without a table only have their XML stored."""
+        with self.connection:
+            for entity in entities:
+                self._add(entity)
+
+    def _add(self, entity):
+        kind = entity._URI
+        execute = self.connection.execute
+        root = entity.root
+        execute(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+            (kind, entity.id, entity.xml()),
+        )
+        execute("DELETE FROM udfs WHERE kind = ? AND entity_id = ?", (kind, entity.id))
+        for node in root.findall(nsmap("udf:field")):
+            number = None
+            if node.attrib.get("type", "").lower() == "numeric" and node.text:
+                try:
+                    number = float(node.text)
+                except ValueError:
+                    pass
+            execute(
+                "INSERT OR REPLACE INTO udfs VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    kind,
+                    entity.id,
+                    node.attrib["name"],
+                    node.attrib.get("type"),
+                    node.text,
+                    number,
+                ),
+            )
+        if isinstance(entity, Sample):
+            execute(
+                "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)",
+                (
+                    entity.id,
+                    _text(root, "name"),
+                    _id(root.find("project")),
+                    _text(root, "date-received"),
+                ),
+            )
+        elif isinstance(entity, Artifact):
+            execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)",
+                (
+                    entity.id,
+                    _text(root, "name"),
+                    _text(root, "type"),
+                    _text(root, "qc-flag"),
+                    _id(root.find("parent-process")),
+                ),
+            )
+            execute("DELETE FROM artifact_samples WHERE artifact_id = ?", (entity.id,))
+            for node in root.findall("sample"):
+                execute(
+                    "INSERT OR REPLACE INTO artifact_samples VALUES (?, ?)",
+                    (entity.id, _id(node)),
+                )
+            execute("DELETE FROM placements WHERE artifact_id = ?", (entity.id,))
+            location = root.find("location")
+            if location is not None and location.find("container") is not None:
+                execute(
+                    "INSERT OR REPLACE INTO placements VALUES (?, ?, ?)",
+                    (
+                        _id(location.find("container")),
+                        _text(location, "value"),
+                        entity.id,
+                    ),
+                )
+        elif isinstance(entity, Process):
+            execute(
+                "INSERT OR REPLACE INTO processes VALUES (?, ?, ?)",
+                (entity.id, _text(root, "type"), _text(root, "date-run")),
+            )
+            execute("DELETE FROM process_io WHERE process_id = ?", (entity.id,))
+            for node in root.findall("input-output-map"):
+                output = node.find("output")
+                execute(
+                    "INSERT INTO process_io VALUES (?, ?, ?, ?)",
+                    (
+                        entity.id,
+                        _id(node.find("input")),
+                        _id(output),
+                        output.attrib.get("output-type")
+                        if output is not None
+                        else None,
+                    ),
+                )
+        elif isinstance(entity, Container):
+            type_node = root.find("type")
+            execute(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?, ?)",
+                (
+                    entity.id,
+                    _text(root, "name"),
+                    type_node.attrib.get("name") if type_node is not None else None,
+                    _text(root, "state"),
+                ),
+            )
+            execute("DELETE FROM placements WHERE container_id = ?", (entity.id,))
+            for node in root.findall("placement"):
+                execute(
+                    "INSERT OR REPLACE INTO placements VALUES (?, ?, ?)",
+                    (entity.id, _text(node, "value"), _id(node)),
+                )
+
+    def load_project(self, project, max_workers=MAX_WORKERS):
+        """Load the samples of the project, their artifacts, the processes
+        producing or using these and the containers holding them, in bulk,
+        and store them all."""
+        lims = self.lims
+        samples, artifacts, processes = load_lineage(
+            lims, lims.get_samples(projectlimsid=project.id), max_workers
+        )
+        containers = dict()
+        for artifact in artifacts:
+            container = artifact.container
+            if container is not None:
+                containers[container.id] = container
+        containers = list(containers.values())
+        failures = lims._load_entities(containers, max_workers)
+        for entity, error in failures.items():
+            logger.warning(f"Could not retrieve {entity}: {error}")
+        self.add(samples + artifacts + processes)
+        self.add(entity for entity in containers if entity not in failures)
+
+    # Store interface of genologics.sync.DeltaSync
+
+    def get_mark(self, name):
+        row = self.connection.execute(
+            "SELECT mark FROM marks WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_mark(self, name, mark):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO marks VALUES (?, ?)", (name, mark)
+            )
+
+    def save(self, name, entities):
+        self.add(entities)
+
+    # Queries
+
+    def rows(self, sql, params=()):
+        "Return the rows of a SQL query on the mirror, as sqlite3.Row."
+        return self.connection.execute(sql, params).fetchall()
+
+    def entities(self, klass, ids):
+        """Return the entities of the given class and LIMS ids; those not
+        loaded yet get the XML stored in the mirror."""
+        result = []
+        for id in ids:
+            entity = klass(self.lims, id=id)
+            if entity.root is None:
+                row = self.connection.execute(
+                    "SELECT xml FROM documents WHERE kind = ? AND id = ?",
+                    (klass._URI, id),
+                ).fetchone()
+                if row is not None:
+                    entity._set_loaded(ElementTree.fromstring(row[0]))
+            result.append(entity)
+        return result
+
+    def _ids(self, sql, params=()):
+        return [row[0] for row in self.connection.execute(sql, params)]
+
+    def samples_by_udf(self, name, op, value, project_id=None):
+        """Return the samples whose UDF compares to value with the operator,
+        one of OPERATORS; numbers are compared numerically."""
+        if op not in OPERATORS:
+            raise ValueError(f"Unsupported operator '{op}'")
+        column = "number" if isinstance(value, (int, float)) else "value"
+        sql = (
+            "SELECT udfs.entity_id FROM udfs JOIN samples"
+            " ON samples.id = udfs.entity_id"
+            f" WHERE udfs.kind = 'samples' AND udfs.name = ? AND udfs.{column} {op} ?"
+        )
+        params = [name, value]
+        if project_id is not None:
+            sql += " AND samples.project_id = ?"
+            params.append(project_id)
+        return self.entities(Sample, self._ids(sql, params))
+
+    def artifacts_of_sample(self, sample_id, type=None):
+        "Return the artifacts of the sample, optionally of the given type."
+        sql = (
+            "SELECT artifact_samples.artifact_id FROM artifact_samples"
+            " JOIN artifacts ON artifacts.id = artifact_samples.artifact_id"
+            " WHERE artifact_samples.sample_id = ?"
+        )
+        params = [sample_id]
+        if type is not None:
+            sql += " AND artifacts.type = ?"
+            params.append(type)
+        return self.entities(Artifact, self._ids(sql, params))
+
+    def artifacts_in_container(self, container_id):
+        "Return the {well: artifact} placements of the container."
+        rows = self.rows(
+            "SELECT well, artifact_id FROM placements WHERE container_id = ?",
+            (container_id,),
+        )
+        artifacts = self.entities(Artifact, [row["artifact_id"] for row in rows])
+        return {row["well"]: artifact for row, artifact in zip(rows, artifacts)}
+
+    def processes_using(self, artifact_id):
+        "Return the processes using the artifact as input."
+        ids = self._ids(
+            "SELECT DISTINCT process_id FROM process_io WHERE input_id = ?",
+            (artifact_id,),
+        )
+        return self.entities(Process, ids)
@@ -0,0 +1,165 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Lazy list queries of entities.
+
+A Query holds the filters of a list query and fetches the result pages
+only when iterated, and only as many as needed:
+
+    failed = lims.artifacts.filter(type="Analyte", qc_flag="FAILED")
+    failed.limit(10).resolve()
+    lims.samples.filter(name="P1_101").first()
+    lims.processes.filter(type="Aggregate QC").exists()
+"""
+
+import threading
+import time
+
+
+class Query:
+    """Lazy list query of the entities of one class.
+
+    Filters use the keyword arguments of the corresponding Lims.get_*
+    method. Queries are immutable: filter() and limit() return new ones.
+    """
+
+    def __init__(self, lims, klass, params=None, limit=None):
+        self.lims = lims
+        self.klass = klass
+        self.params = dict(params or {})
+        self._limit = limit
+
+    def __repr__(self):
+        return f"Query({self.klass.__name__}, {self.params}, limit={self._limit})"
+
+    def filter(self, udf=None, udtname=None, udt=None, **kwargs):
+        "Return a query further filtered by the given keyword arguments."
+        params = dict(self.params)
+        params.update(self.lims._get_params(**kwargs))
+        params.update(
+            self.lims._get_params_udf(udf=udf or {}, udtname=udtname, udt=udt or {})
+        )
+        return Query(self.lims, self.klass, params, self._limit)
+
+    def limit(self, limit):
+        "Return a query stopping after the given number of entities."
+        return Query(self.lims, self.klass, self.params, limit)
+
+    def _pages(self):
+        remaining = self._limit
+        if remaining is not None and remaining <= 0:
+            return
+        for page in self.lims._iter_instances(self.klass, self.params):
+            if remaining is not None:
+                page = page[:remaining]
+                remaining -= len(page)
+            yield page
+            if remaining is not None and remaining <= 0:
+                return
+
+    def iter(self):
+        """Yield the entities matching the query, fetching the next page of
+        results only when the previous one has been consumed."""
+        for page in self._pages():
+            yield from page
+
+    __iter__ = iter
+
+    def iter_resolved(self, max_workers=None):
+        """Yield the entities matching the query with their XML loaded.
+        Each page of results is loaded, with a batch call where available,
+        by a pool of workers while the next pages are fetched."""
+        return self.lims._iter_resolved(self._pages(), max_workers=max_workers)
+
+    def first(self):
+        "Return the first matching entity, or None; fetches a single page."
+        for instance in self.limit(1).iter():
+            return instance
+        return None
+
+    def exists(self):
+        "Return True if any entity matches the query."
+        return self.first() is not None
+
+    def count(self, max_workers=None):
+        """Return the number of matching entities, counting the nodes of the
+        result pages without creating entities. Without a limit, the pages
+        are fetched in parallel by max_workers."""
+        if self._limit is None:
+            return self.lims._count(self.klass, self.params, max_workers)
+        total = 0
+        for nodes in self.lims._iter_nodes(self.klass, self.params):
+            total += len(nodes)
+            if total >= self._limit:
+                return self._limit
+        return total
+
+    def resolve(self):
+        """Return the list of matching entities, with their XML loaded by
+        batch calls where available, or else by concurrent GETs."""
+        return list(self.iter_resolved())
+
+
+class QueryCache:
+    """Cache of the results of list queries, keyed by the queried endpoint
+    and the normalized query parameters, each kept for ttl seconds.
+
+    It is separate from the cache of entities in Lims.cache: it only spares
+    the list requests, the entities being shared as usual. Give it to Lims
+    as query_cache to have the get_* methods use it.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(klass, params):
+        "Return the cache key of a list query, ignoring the order of values."
+        items = []
+        for name, value in params.items():
+            if isinstance(value, (list, tuple, set)):
+                value = tuple(sorted(str(v) for v in value))
+            else:
+                value = str(value)
+            items.append((name, value))
+        return (klass._URI, tuple(sorted(items)))
+
+    def get(self, key):
+        "Return the cached results for the key, or None if missing or expired."
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, results):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, results)
+
+    def invalidate(self, klass=None):
+        "Drop the cached results of the queries on the given class, or all."
+        with self._lock:
+            if klass is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == klass._URI]:
+                    del self._entries[key]
+
+    def stats(self):
+        "Return the numbers of hits, misses and entries, and the hit rate."
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,243 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Change feed of the LIMS entities.
+
+ChangeWatcher polls the list endpoints with their last-modified filter,
+through genologics.sync.DeltaSync, and compares the entities pulled with
+the previous snapshot of each, to dispatch events to callbacks:
+
+    watcher = ChangeWatcher(lims, types=["processes", "containers"])
+    watcher.subscribe(on_new_process, name="processes", kind=CREATED)
+    watcher.subscribe(on_udf_change, kind=UDF_CHANGED)
+    watcher.run()
+
+or to yield them:
+
+    for event in watcher.events():
+        ...
+
+The poll interval adapts to the activity: it drops to min_interval after a
+poll with events, and doubles after each quiet poll, up to max_interval.
+
+The watcher keeps a snapshot of at most max_entities entities per type,
+dropping the least recently changed ones. The entities it lists or pulls
+without an event are removed from the identity map of the LIMS interface,
+unless they were already in it, so that its memory use stays bounded when
+it runs for long; the entities of events stay in it, so that they are the
+ones given for their URI or id afterwards.
+"""
+
+import datetime
+import hashlib
+import time
+from collections import OrderedDict
+
+from genologics.lims import MAX_WORKERS
+from genologics.sync import OVERLAP, SYNC_TYPES, DeltaSync
+
+# Kinds of events
+CREATED = "created"
+MODIFIED = "modified"
+UDF_CHANGED = "udf-changed"
+
+
+class Event:
+    """Change of an entity seen by a ChangeWatcher.
+
+    kind: CREATED, MODIFIED or UDF_CHANGED. An entity whose XML changed
+          gives a MODIFIED event, and also an UDF_CHANGED event if any of
+          its UDFs changed.
+    name: name of the entity type in SYNC_TYPES, such as 'processes'.
+    entity: the entity, with its new XML loaded.
+    changes: for UDF_CHANGED, UDF name -> (old value, new value), with
+             None for a missing value.
+    """
+
+    def __init__(self, kind, name, entity, changes=None):
+        self.kind = kind
+        self.name = name
+        self.entity = entity
+        self.changes = changes or dict()
+
+    def __repr__(self):
+        return f"Event({self.kind}, {self.entity})"
+
+
+class ChangeWatcher:
+    """Polls the LIMS for modified entities and dispatches change events.
+
+    types: names of SYNC_TYPES to watch, all of them by default.
+    baseline: if True, the ids of the existing entities are listed when
+              the watcher starts, without loading them, so that entities
+              created later are told apart from modified ones. Otherwise,
+              any entity not seen before gives a CREATED event.
+    max_entities: number of entities of each type kept in the snapshots.
+              An entity dropped from them gives a CREATED event when it
+              changes again.
+    """
+
+    def __init__(
+        self,
+        lims,
+        types=None,
+        baseline=True,
+        min_interval=5,
+        max_interval=300,
+        overlap=OVERLAP,
+        max_workers=MAX_WORKERS,
+        max_entities=100000,
+    ):
+        self.lims = lims
+        self.types = list(types or SYNC_TYPES)
+        self.baseline = baseline
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.max_entities = max_entities
+        self.subscriptions = []
+        # type name -> {LIMS id: (XML digest, UDF values, last-modified of
+        # the list node)}, or None for entities known to exist but not
+        # loaded yet; ordered from the least recently changed
+        self.snapshots = dict()
+        # Entities listed during the current poll, see _release(), and
+        # URI -> last-modified time given by their list node
+        self._listed = []
+        self._modified = dict()
+        self.marks = dict()
+        self._events = []
+        self._sync = DeltaSync(
+            lims, self, types=self.types, overlap=overlap, max_workers=max_workers
+        )
+
+    def subscribe(self, callback, name=None, kind=None):
+        """Call callback(event) for the events of the given type name and
+        kind, or of all of them when not given."""
+        self.subscriptions.append((callback, name, kind))
+
+    def start(self):
+        "Take the initial snapshot; done by the first poll if not called."
+        for name in self.types:
+            if name in self.marks:
+                continue
+            # Marks as in DeltaSync: taken before listing, minus the overlap
+            started = self._sync._now()
+            snapshot = self._snapshot(name)
+            if self.baseline:
+                cached = set(self.lims.cache)
+                entities = list(self.lims.query(SYNC_TYPES[name]))
+                for entity in entities:
+                    snapshot.setdefault(entity.id, None)
+                self._trim(snapshot)
+                self._release(entities, cached)
+            self.marks[name] = self._format(started)
+
+    def _snapshot(self, name):
+        return self.snapshots.setdefault(name, OrderedDict())
+
+    def _trim(self, snapshot):
+        while len(snapshot) > self.max_entities:
+            snapshot.popitem(last=False)
+
+    def _release(self, entities, cached):
+        "Remove from the identity map the entities not in the cached URIs."
+        for entity in entities:
+            if entity.uri not in cached:
+                self.lims.cache.pop(entity.uri, None)
+
+    def _format(self, moment):
+        moment -= datetime.timedelta(seconds=self._sync.overlap)
+        return moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    # Store interface of DeltaSync
+    def get_mark(self, name):
+        return self.marks.get(name)
+
+    def set_mark(self, name, mark):
+        self.marks[name] = mark
+
+    def select(self, name, entities, nodes):
+        """Skip the listed entities whose list node gives a last-modified
+        time not newer than the one of their snapshot, such as those listed
+        again because of the overlap, to avoid loading them again."""
+        self._listed.extend(entities)
+        snapshot = self._snapshot(name)
+        selected = []
+        for entity, node in zip(entities, nodes):
+            previous = snapshot.get(entity.id)
+            modified = node.get("last-modified")
+            self._modified[entity.uri] = modified
+            if previous is None or modified is None or previous[2] is None:
+                selected.append(entity)
+            elif modified > previous[2]:
+                selected.append(entity)
+        return selected
+
+    def save(self, name, entities):
+        "Compare the pulled entities with their snapshot and record events."
+        snapshot = self._snapshot(name)
+        for entity in entities:
+            digest = hashlib.sha1(entity.xml()).digest()
+            udfs = dict(entity.udf.items())
+            modified = self._modified.get(entity.uri)
+            if entity.id not in snapshot:
+                self._events.append(Event(CREATED, name, entity))
+            else:
+                previous = snapshot[entity.id]
+                if previous is None:
+                    self._events.append(Event(MODIFIED, name, entity))
+                elif previous[0] != digest:
+                    self._events.append(Event(MODIFIED, name, entity))
+                    changes = dict()
+                    for udf in set(previous[1]) | set(udfs):
+                        old, new = previous[1].get(udf), udfs.get(udf)
+                        if old != new:
+                            changes[udf] = (old, new)
+                    if changes:
+                        self._events.append(Event(UDF_CHANGED, name, entity, changes))
+            snapshot[entity.id] = (digest, udfs, modified)
+            snapshot.move_to_end(entity.id)
+        self._trim(snapshot)
+
+    def poll(self):
+        """Pull the entities modified since the previous poll, dispatch the
+        events to the subscribed callbacks and return them. Entities pulled
+        again without change, because of the overlap, give no events."""
+        self.start()
+        self._events = []
+        cached = set(self.lims.cache)
+        try:
+            self._sync.sync()
+        finally:
+            changed = {event.entity.uri for event in self._events}
+            self._release(
+                [entity for entity in self._listed if entity.uri not in changed],
+                cached,
+            )
+            self._listed = []
+            self._modified = dict()
+        events, self._events = self._events, []
+        for event in events:
+            for callback, name, kind in self.subscriptions:
+                if name in (None, event.name) and kind in (None, event.kind):
+                    callback(event)
+        if events:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        return events
+
+    def events(self):
+        "Poll forever, yielding the events and sleeping between polls."
+        while True:
+            yield from self.poll()
+            time.sleep(self.interval)
+
+    def run(self, polls=None):
+        """Poll and dispatch the events to the callbacks, forever or the
+        given number of times."""
+        count = 0
+        while polls is None or count < polls:
+            self.poll()
+            count += 1
+            if polls is None or count < polls:
+                time.sleep(self.interval)
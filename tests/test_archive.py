@@ -0,0 +1,96 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from xml.etree import ElementTree
+
+from genologics.archive import ArchiveReader, ArchiveWriter
+from genologics.entities import Artifact, Sample
+from genologics.lims import Lims
+
+url = "http://testgenologics.com:4040"
+
+artifact_xml = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{url}/api/v2/artifacts/{id}?state=1" limsid="{id}">
+<name>{name}</name>
+<type>Analyte</type>
+</art:artifact>"""
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "snapshot")
+        self.lims = Lims(url, username="test", password="password")
+        self.artifacts = []
+        for i in range(3):
+            artifact = Artifact(self.lims, id=f"a{i}")
+            artifact.root = ElementTree.fromstring(
+                artifact_xml.format(url=url, id=f"a{i}", name=f"A{i}")
+            )
+            self.artifacts.append(artifact)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_roundtrip(self):
+        with ArchiveWriter(self.path) as writer:
+            assert writer.add(self.artifacts[:2]) == 2
+        with ArchiveWriter(self.path, compress=False) as writer:
+            self.artifacts[1].root.find("name").text = "A1 renamed"
+            writer.add(self.artifacts[1:])
+        reader = ArchiveReader(self.path)
+        assert len(reader) == 3
+        assert "artifacts/a0" in reader
+        assert b"A1 renamed" in reader.get("artifacts/a1")
+        assert reader.get("artifacts/missing") is None
+        assert reader.load(self.artifacts[0]).find("name").text == "A0"
+        reader.close()
+
+    def test_backing_store(self):
+        with ArchiveWriter(self.path) as writer:
+            writer.add(self.artifacts[:2])
+        lims = Lims(
+            url,
+            username="test",
+            password="password",
+            backing_store=ArchiveReader(self.path),
+        )
+        with (
+            patch("requests.Session.get") as mocked_get,
+            patch.object(lims, "get_batch") as mocked_batch,
+        ):
+            assert Artifact(lims, id="a0").name == "A0"
+            artifact = Artifact(lims, id="a1")
+            assert lims._load_entities([artifact]) == {}
+            assert artifact.type == "Analyte"
+            assert mocked_get.call_count == 0
+            assert mocked_batch.call_count == 0
+            lims._load_entities([Artifact(lims, id="a2")])
+            assert mocked_batch.call_count == 1
+
+    def test_empty(self):
+        ArchiveWriter(self.path).close()
+        reader = ArchiveReader(self.path)
+        assert len(reader) == 0
+        assert reader.load(Sample(self.lims, id="s1")) is None
+
+    def test_partial_tail(self):
+        with ArchiveWriter(self.path) as writer:
+            writer.add(self.artifacts)
+        # An append interrupted in the middle of the last index record
+        with open(self.path + ".index", "r+b") as f:
+            f.truncate(os.path.getsize(self.path + ".index") - 3)
+        with self.assertLogs("genologics.archive", level="WARNING"):
+            reader = ArchiveReader(self.path)
+        assert sorted(reader.keys()) == ["artifacts/a0", "artifacts/a1"]
+        assert reader.load(self.artifacts[1]).find("name").text == "A1"
+        offset = reader.entries["artifacts/a1"][0]
+        reader.close()
+
+        # An index record whose blob was not fully written
+        with open(self.path + ".data", "r+b") as f:
+            f.truncate(offset + 1)
+        with self.assertLogs("genologics.archive", level="WARNING"):
+            reader = ArchiveReader(self.path)
+        assert sorted(reader.keys()) == ["artifacts/a0"]
+        reader.close()
@@ -0,0 +1,135 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from xml.etree import ElementTree
+
+from genologics.crawler import ProjectCrawler, WorkQueue
+from genologics.entities import Artifact, File, Process, Project, Sample
+from genologics.lims import Lims
+
+url = "http://testgenologics.com:4040"
+
+
+class TestProjectCrawler(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "crawl.sqlite")
+        self.lims = Lims(url, username="test", password="password")
+        self.visited = []
+        self.fail_stage = None
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def entity(self, klass, id, children="", uri=None):
+        entity = klass(self.lims, id=None if uri else id, uri=uri)
+        entity.root = ElementTree.fromstring(
+            f'<entity xmlns:file="http://genologics.com/ri/file">{children}</entity>'
+        )
+        return entity
+
+    def visit(self, project, stage, entities):
+        if project.id == "p1" and stage == self.fail_stage:
+            raise RuntimeError("visitor failed")
+        self.visited.append((project.id, stage, sorted(e.id for e in entities)))
+
+    def test_crawl(self):
+        file_link = f'<file:file uri="{url}/api/v2/files/f1" limsid="f1"/>'
+        samples = {"p1": [self.entity(Sample, "s1")], "p2": []}
+        artifacts = [self.entity(Artifact, "a1", file_link)]
+        processes = [self.entity(Process, "pr1", file_link)]
+        self.entity(File, "f1", uri=f"{url}/api/v2/files/f1")
+        crawler = ProjectCrawler(
+            self.lims, self.path, visit=self.visit, workers=2, max_attempts=1
+        )
+        assert (
+            crawler.seed([Project(self.lims, id="p1"), Project(self.lims, id="p2")])
+            == 2
+        )
+        assert crawler.seed([Project(self.lims, id="p1")]) == 0
+        self.fail_stage = "processes"
+        with (
+            patch.object(
+                self.lims,
+                "get_samples",
+                side_effect=lambda projectlimsid: samples[projectlimsid],
+            ) as get_samples,
+            patch.object(self.lims, "get_artifacts", return_value=artifacts),
+            patch.object(self.lims, "get_processes", return_value=processes),
+        ):
+            assert crawler.run() == dict(pending=0, running=0, done=1, failed=1)
+            assert sorted(self.visited) == [
+                ("p1", "artifacts", ["a1"]),
+                ("p1", "samples", ["s1"]),
+                ("p2", "artifacts", []),
+                ("p2", "files", []),
+                ("p2", "processes", []),
+                ("p2", "samples", []),
+            ]
+            assert "visitor failed" in crawler.queue.errors()["p1"]
+
+            # Resumes p1 from its processes, listing but not visiting samples
+            self.visited = []
+            self.fail_stage = None
+            crawler.queue.retry_failed()
+            get_samples.reset_mock()
+            assert crawler.run()["done"] == 2
+            assert self.visited == [
+                ("p1", "processes", ["pr1"]),
+                ("p1", "files", ["f1"]),
+            ]
+            assert get_samples.call_count == 1
+            assert crawler.entity_count == 2
+
+    def test_plan(self):
+        with self.assertRaises(ValueError):
+            ProjectCrawler(self.lims, self.path, plan=["samples", "pools"])
+        crawler = ProjectCrawler(self.lims, self.path, plan=["files", "samples"])
+        assert crawler.plan == ["samples", "files"]
+
+    def test_lease(self):
+        queue = WorkQueue(self.path, lease=60)
+        queue.add(["p1"])
+        assert queue.claim("w1") == ("p1", 0)
+        assert queue.checkpoint("p1", "w1", 2)
+        assert queue.claim("w2") is None
+        with patch("genologics.crawler.time.time", return_value=10**10):
+            assert queue.claim("w2") == ("p1", 2)
+        # w1 lost its lease, its updates are ignored
+        assert not queue.checkpoint("p1", "w1", 3)
+        assert not queue.complete("p1", "w1")
+        assert not queue.fail("p1", "w1", "error", 3)
+        assert queue.renew("p1", "w2")
+        assert queue.progress()["running"] == 1
+        queue.release()
+        assert queue.progress()["pending"] == 1
+
+    def test_lease_lost(self):
+        crawler = ProjectCrawler(self.lims, self.path, plan=["samples"])
+        crawler.seed([Project(self.lims, id="p1")])
+
+        def get_samples(projectlimsid):
+            # Another worker claims the project meanwhile
+            with patch("genologics.crawler.time.time", return_value=10**10):
+                crawler.queue.claim("other")
+            return []
+
+        with patch.object(self.lims, "get_samples", side_effect=get_samples):
+            assert crawler.run() == dict(pending=0, running=1, done=0, failed=0)
+
+    def test_lease_renewed(self):
+        crawler = ProjectCrawler(self.lims, self.path, plan=["samples"], lease=0.3)
+        crawler.seed([Project(self.lims, id="p1")])
+        claims = []
+
+        def get_samples(projectlimsid):
+            # Longer than the lease, which is renewed meanwhile
+            time.sleep(0.6)
+            claims.append(crawler.queue.claim("other"))
+            return []
+
+        with patch.object(self.lims, "get_samples", side_effect=get_samples):
+            assert crawler.run()["done"] == 1
+        assert claims == [None]
@@ -1,11 +1,13 @@
 from io import BytesIO
 from unittest import TestCase
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from xml.etree import ElementTree
 
 from genologics.descriptors import (
     BooleanDescriptor,
     EntityDescriptor,
+    InputOutputMapIndexDescriptor,
+    InputOutputMapList,
     IntegerDescriptor,
     StringAttributeDescriptor,
     StringDescriptor,
@@ -200,6 +202,88 @@ class TestStringDictionaryDescriptor(TestDescriptor):
         assert res["test-secondkey"] == "second value"
 
 
+class TestInputOutputMapList(TestDescriptor):
+    def setUp(self):
+        self.et = ElementTree.fromstring("""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<test-entry>
+<input-output-map>
+<input uri="http://testgenologics.com:4040/api/v2/artifacts/a1" limsid="a1"/>
+<output uri="http://testgenologics.com:4040/api/v2/artifacts/o1" output-type="Analyte" output-generation-type="PerInput" limsid="o1"/>
+</input-output-map>
+<input-output-map>
+<input uri="http://testgenologics.com:4040/api/v2/artifacts/a1" limsid="a1"/>
+<output uri="http://testgenologics.com:4040/api/v2/artifacts/o2" output-type="ResultFile" output-generation-type="PerInput" limsid="o2"/>
+</input-output-map>
+<input-output-map>
+<input uri="http://testgenologics.com:4040/api/v2/artifacts/a2" limsid="a2"/>
+<output uri="http://testgenologics.com:4040/api/v2/artifacts/o3" output-type="SharedResultFile" output-generation-type="PerAllInputs" limsid="o3"/>
+</input-output-map>
+<input-output-map>
+<input uri="http://testgenologics.com:4040/api/v2/artifacts/a1" limsid="a1"/>
+<output uri="http://testgenologics.com:4040/api/v2/artifacts/o3" output-type="SharedResultFile" output-generation-type="PerAllInputs" limsid="o3"/>
+</input-output-map>
+</test-entry>""")
+        self.lims = Lims(
+            "http://testgenologics.com:4040", username="test", password="password"
+        )
+        self.instance = Mock(root=self.et, lims=self.lims)
+
+    def test__get__(self):
+        iol = self._make_desc(InputOutputMapList)
+        maps = iol.__get__(self.instance, None)
+        assert len(maps) == 4
+        assert maps[0][0]["limsid"] == "a1"
+        assert maps[0][0]["uri"] == Artifact(self.lims, id="a1")
+        assert maps[0][1]["output-type"] == "Analyte"
+        assert iol.__get__(self.instance, None) is maps
+        self.instance.root = ElementTree.fromstring(self._tostring(self.et))
+        assert iol.__get__(self.instance, None) is not maps
+
+    def test_state(self):
+        self.instance.root = ElementTree.fromstring("""<test-entry>
+<input-output-map>
+<input uri="http://testgenologics.com:4040/api/v2/artifacts/a1?state=12" limsid="a1"/>
+<output uri="http://testgenologics.com:4040/api/v2/artifacts/o1?state=13" output-type="Analyte" limsid="o1"/>
+</input-output-map>
+</test-entry>""")
+        iol = self._make_desc(InputOutputMapList)
+        input, output = iol.__get__(self.instance, None)[0]
+        artifact = Artifact(self.lims, id="a1")
+        assert input["uri"] is artifact
+        assert input["state"] == "12"
+        snapshot = input["uri"].at_state(input["state"])
+        assert snapshot is not artifact
+        assert snapshot.uri == artifact.uri + "?state=12"
+        assert output["state"] == "13"
+        # The artifact at that state is read, not the current one
+        with patch(
+            "requests.Session.get",
+            return_value=Mock(
+                content="""<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="http://testgenologics.com:4040/api/v2/artifacts/a1?state=12" limsid="a1">
+<qc-flag>PASSED</qc-flag></art:artifact>""",
+                status_code=200,
+            ),
+        ) as mocked_get:
+            assert snapshot.qc_flag == "PASSED"
+            assert mocked_get.call_args[0][0] == artifact.uri + "?state=12"
+
+    def test_index(self):
+        iod = self._make_desc(InputOutputMapIndexDescriptor)
+        index = iod.__get__(self.instance, None)
+        assert index.input_ids() == ["a1", "a2"]
+        assert index.output_ids() == ["o1", "o2", "o3"]
+        assert index.output_ids(output_type="SharedResultFile") == ["o3"]
+        assert [o["limsid"] for o in index.outputs_per_input("a1")] == [
+            "o1",
+            "o2",
+            "o3",
+        ]
+        assert [o["limsid"] for o in index.outputs_per_input("a1", "Analyte")] == ["o1"]
+        assert [i["limsid"] for i in index.inputs_per_output("o3")] == ["a2", "a1"]
+        assert len(index.by_generation_type["PerAllInputs"]) == 2
+        assert iod.__get__(self.instance, None) is index
+
+
 class TestUdfDictionary(TestCase):
     def setUp(self):
         self.et = ElementTree.fromstring("""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
@@ -1,11 +1,14 @@
+import time
 from unittest import TestCase
 from unittest.mock import Mock, patch
+from urllib.parse import urlsplit
 from xml.etree import ElementTree
 
 from genologics.entities import (
     Artifact,
     Container,
     Project,
+    Queue,
     ReagentKit,
     ReagentLot,
     Researcher,
@@ -203,6 +206,93 @@ class TestEntities(TestCase):
         return self.lims.tostring(ElementTree.ElementTree(entity.root)).decode("utf-8")
 
 
+class TestEntityId(TestEntities):
+    def test_id_is_memoized(self):
+        a = Artifact(self.lims, uri=self.lims.get_uri("artifacts", "a1"))
+        with patch("genologics.entities.urlsplit", wraps=urlsplit) as mocked_split:
+            assert a.id == "a1"
+            assert a.id == "a1"
+            assert mocked_split.call_count == 1
+
+    def test_id_follows_uri(self):
+        a = Artifact(self.lims, uri=self.lims.get_uri("artifacts", "a1"))
+        assert a.id == "a1"
+        a._uri = self.lims.get_uri("artifacts", "a2")
+        assert a.id == "a2"
+
+
+class TestEntityPut(TestEntities):
+    def setUp(self):
+        super().setUp()
+        self.artifact = Artifact(self.lims, id="a1")
+        self.artifact.root = ElementTree.fromstring(
+            generic_artifact_xml.format(url=url)
+        )
+
+    def test_put_unchanged(self):
+        a = self.artifact
+        a.udf["Ave. Conc. (ng/uL)"] = 1
+        a.name = "test_sample1"
+        assert not a.is_modified()
+        with patch("genologics.lims.Lims.put") as mocked_put:
+            assert a.put() is False
+            assert mocked_put.call_count == 0
+            assert a.put(force=True) is True
+            assert mocked_put.call_count == 1
+
+    def test_put_changed(self):
+        a = self.artifact
+        a.udf["Ave. Conc. (ng/uL)"] = 2
+        assert a.is_modified()
+        with patch("genologics.lims.Lims.put") as mocked_put:
+            assert a.put() is True
+            assert a.put() is False
+            assert mocked_put.call_count == 1
+
+    def test_put_applies_response(self):
+        a = self.artifact
+        a.name = "renamed"
+        response = ElementTree.fromstring(generic_artifact_xml.format(url=url))
+        response.find("qc-flag").text = "FAILED"
+        with patch("genologics.lims.Lims.put", return_value=response):
+            assert a.put() is True
+        assert a.root is response
+        assert a.qc_flag == "FAILED"
+        assert not a.is_modified()
+
+    def test_put_root_edit(self):
+        a = self.artifact
+        a.name = "test_sample1"
+        a.root.find("name").text = "renamed"
+        assert a.is_modified()
+
+    def test_put_loaded(self):
+        a = Artifact(self.lims, id="a2")
+        with patch(
+            "genologics.lims.Lims.get",
+            return_value=ElementTree.fromstring(generic_artifact_xml.format(url=url)),
+        ):
+            a.get()
+        assert not a.is_modified()
+        with patch("genologics.lims.Lims.put") as mocked_put:
+            assert a.put() is False
+            a.root.find("name").text = "renamed"
+            assert a.is_modified()
+            assert a.put() is True
+            assert mocked_put.call_count == 1
+
+    def test_put_batch_unchanged(self):
+        a = self.artifact
+        a.qc_flag = "PASSED"
+        with patch("genologics.lims.Lims.post") as mocked_post:
+            self.lims.put_batch([a])
+            assert mocked_post.call_count == 0
+            a.qc_flag = "FAILED"
+            self.lims.put_batch([a])
+            assert mocked_post.call_count == 1
+        assert not a.is_modified()
+
+
 class TestStepActions(TestEntities):
     step_actions_xml = generic_step_actions_xml.format(url=url)
     step_actions_no_escalation_xml = generic_step_actions_no_escalation_xml.format(
@@ -218,7 +308,7 @@ class TestStepActions(TestEntities):
             return_value=Mock(content=self.step_actions_xml, status_code=200),
         ):
             with patch(
-                "requests.post",
+                "requests.Session.post",
                 return_value=Mock(content=self.dummy_xml, status_code=200),
             ):
                 r = Researcher(
@@ -433,7 +523,7 @@ class TestReagentKits(TestEntities):
 
     def test_create_entity(self):
         with patch(
-            "genologics.lims.requests.post",
+            "requests.Session.post",
             return_value=Mock(content=self.reagentkit_xml, status_code=201),
         ):
             ReagentKit.create(
@@ -468,7 +558,7 @@ class TestReagentLots(TestEntities):
         ):
             r = ReagentKit(uri=self.lims.get_uri("reagentkits", "r1"), lims=self.lims)
         with patch(
-            "genologics.lims.requests.post",
+            "requests.Session.post",
             return_value=Mock(content=self.reagentlot_xml, status_code=201),
         ):
             l = ReagentLot.create(
@@ -489,7 +579,7 @@ class TestSample(TestEntities):
 
     def test_create_entity(self):
         with patch(
-            "genologics.lims.requests.post",
+            "requests.Session.post",
             return_value=Mock(content=self.sample_creation, status_code=201),
         ) as patch_post:
             Sample.create(
@@ -512,3 +602,144 @@ class TestSample(TestEntities):
                 ElementTree.fromstring(patch_post.call_args_list[0][1]["data"]),
                 ElementTree.fromstring(data),
             )
+
+
+class TestStep(TestEntities):
+    step_xml = """<stp:step xmlns:stp="http://genologics.com/ri/step" uri="{url}/api/v2/steps/s1" current-state="Record Details">
+<configuration uri="{url}/api/v2/configuration/protocols/1/steps/1">Step name</configuration>
+<details uri="{url}/api/v2/steps/s1/details"/>
+</stp:step>"""
+    details_xml = """<stp:details xmlns:stp="http://genologics.com/ri/step" uri="{url}/api/v2/steps/s1/details">
+<input-output-maps>
+<input-output-map>
+<input uri="{url}/api/v2/artifacts/a1" limsid="a1"/>
+<output uri="{url}/api/v2/artifacts/o1" limsid="o1" type="Analyte" output-generation-type="PerInput"/>
+</input-output-map>
+</input-output-maps>
+</stp:details>"""
+
+    def test_advance_invalidates(self):
+        step = Step(self.lims, id="s1")
+        step.root = ElementTree.fromstring(self.step_xml.format(url=url))
+        step.details.root = ElementTree.fromstring(self.details_xml.format(url=url))
+        artifact = Artifact(self.lims, id="o1")
+        artifact.root = ElementTree.fromstring(generic_artifact_xml.format(url=url))
+        with patch(
+            "genologics.lims.Lims.post",
+            return_value=ElementTree.fromstring(self.step_xml.format(url=url)),
+        ):
+            step.advance()
+        assert step.details.root is None
+        assert artifact.root is None
+        assert artifact.uri in self.lims.stale
+
+
+class TestArtifactStates(TestEntities):
+    def test_canonical_uri(self):
+        stateless_uri = self.lims.get_uri("artifacts", "a1")
+        a = Artifact(self.lims, uri=stateless_uri + "?state=2")
+        assert a.uri == stateless_uri
+        assert Artifact(self.lims, uri=stateless_uri + "?state=3") is a
+        assert Artifact(self.lims, id="a1") is a
+        a.root = ElementTree.fromstring(
+            f'<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{stateless_uri}?state=3" limsid="a1"/>'
+        )
+        assert a.state == "3"
+        snapshot = a.at_state("2")
+        assert snapshot is not a
+        assert snapshot.uri == stateless_uri + "?state=2"
+        assert snapshot.state == "2"
+        assert snapshot.uri not in self.lims.cache
+        assert a.at_state(None) is a
+
+    def test_artifact_states(self):
+        lims = Lims(url, username="test", password="password", artifact_states=True)
+        stateless_uri = lims.get_uri("artifacts", "a1")
+        a = Artifact(lims, uri=stateless_uri + "?state=2")
+        assert a.uri == stateless_uri + "?state=2"
+        assert a.state == "2"
+        assert Artifact(lims, uri=stateless_uri) is not a
+        assert a.stateless is Artifact(lims, uri=stateless_uri)
+        assert a.stateless.at_state("2") is a
+
+
+class TestQueue(TestEntities):
+    def queue_page(self, ids, next_page=""):
+        artifacts = "\n".join(
+            f'''<artifact uri="{url}/api/v2/artifacts/{id}?state=1" limsid="{id}">
+<queue-time>2024-01-01T10:00:00.000+01:00</queue-time>
+<location><container uri="{url}/api/v2/containers/c1" limsid="c1"/><value>A:{id[1:]}</value></location>
+</artifact>'''
+            for id in ids
+        )
+        if next_page:
+            next_page = f'<next-page uri="{url}/api/v2/queues/1?{next_page}"/>'
+        return f'<que:queue xmlns:que="http://genologics.com/ri/queue" uri="{url}/api/v2/queues/1"><artifacts>{artifacts}</artifacts>{next_page}</que:queue>'
+
+    def setUp(self):
+        super().setUp()
+        self.pages = {
+            None: self.queue_page(["a1", "a2"], "start-index=2"),
+            2: self.queue_page(["a3", "a4"], "start-index=4"),
+            4: self.queue_page(["a5"]),
+            6: self.queue_page([]),
+        }
+
+    def get(self, uri, params=None, **kwargs):
+        return Mock(
+            content=self.pages[(params or {}).get("start-index")], status_code=200
+        )
+
+    def test_iter_artifacts(self):
+        queue = Queue(self.lims, id="1")
+        with patch("requests.Session.get", side_effect=self.get) as mocked_get:
+            items = list(queue.iter_artifacts(max_workers=2))
+            assert mocked_get.call_count == 4
+        assert [a.id for a, _, _ in items] == ["a1", "a2", "a3", "a4", "a5"]
+        artifact, queue_time, (container, well) = items[2]
+        assert artifact is Artifact(self.lims, id="a3")
+        assert queue_time == "2024-01-01T10:00:00.000+01:00"
+        assert container is Container(self.lims, id="c1")
+        assert well == "A:3"
+        assert set(self.lims.cache) == {queue.uri, container.uri} | {
+            a.uri for a, _, _ in items
+        }
+
+    def test_last_page(self):
+        queue = Queue(self.lims, id="1")
+
+        def get(uri, params=None, **kwargs):
+            if (params or {}).get("start-index") == 2:
+                # The last page arrives first
+                time.sleep(0.1)
+            return self.get(uri, params)
+
+        with patch("requests.Session.get", side_effect=get) as mocked_get:
+            items = []
+            for item in queue.iter_artifacts(max_workers=2):
+                items.append(item)
+                time.sleep(0.02)
+            # No page requested past the last one
+            assert mocked_get.call_count == 3
+        assert len(items) == 5
+
+    def test_early_stop(self):
+        queue = Queue(self.lims, id="1")
+        with patch("requests.Session.get", side_effect=self.get) as mocked_get:
+            for artifact, _, _ in queue.iter_artifacts(max_workers=1):
+                break
+            assert mocked_get.call_count <= 2
+
+    def test_artifacts(self):
+        self.pages[None] = self.queue_page(["a1", "a2"], "page2=x")
+        self.pages["x"] = self.queue_page(["a3"])
+
+        def get(uri, params=None, **kwargs):
+            return Mock(
+                content=self.pages["x" if "page2" in uri else None], status_code=200
+            )
+
+        queue = Queue(self.lims, id="1")
+        with patch("requests.Session.get", side_effect=get):
+            assert [a.id for a in queue.artifacts] == ["a1", "a2", "a3"]
+        assert len([uri for uri in self.lims.cache if "queues" in uri]) == 1
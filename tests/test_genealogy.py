@@ -0,0 +1,171 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from xml.etree import ElementTree
+
+from genologics.entities import (
+    Artifact,
+    Process,
+    Processtype,
+    Project,
+    Sample,
+    SampleHistory,
+)
+from genologics.genealogy import Genealogy, build_processes_per_artifact
+from genologics.lims import Lims
+
+url = "http://testgenologics.com:4040"
+
+generic_process_xml = """<?xml version='1.0' encoding='utf-8'?>
+<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{url}/api/v2/processes/{pid}" limsid="{pid}">
+<type uri="{url}/api/v2/processtypes/{tid}">{name}</type>
+<date-run>2024-01-0{day}</date-run>
+{maps}
+</prc:process>"""
+
+generic_map_xml = """<input-output-map>
+<input uri="{url}/api/v2/artifacts/{input}" limsid="{input}"/>
+<output uri="{url}/api/v2/artifacts/{output}" output-type="{type}" output-generation-type="PerInput" limsid="{output}"/>
+</input-output-map>"""
+
+generic_artifact_xml = """<?xml version='1.0' encoding='utf-8'?>
+<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{url}/api/v2/artifacts/{aid}" limsid="{aid}">
+<name>{aid}</name>
+<type>{type}</type>
+{parent}
+<sample uri="{url}/api/v2/samples/s1" limsid="s1"/>
+</art:artifact>"""
+
+sample_xml = """<?xml version='1.0' encoding='utf-8'?>
+<smp:sample xmlns:smp="http://genologics.com/ri/sample" uri="{url}/api/v2/samples/s1" limsid="s1">
+<name>S1</name>
+</smp:sample>"""
+
+processtype_xml = """<?xml version='1.0' encoding='utf-8'?>
+<ptp:process-type xmlns:ptp="http://genologics.com/ri/processtype" uri="{url}/api/v2/processtypes/{tid}" name="{name}"/>"""
+
+
+class TestGenealogy(TestCase):
+    def setUp(self):
+        self.lims = Lims(url, username="test", password="password")
+        Sample(self.lims, id="s1").root = ElementTree.fromstring(
+            sample_xml.format(url=url)
+        )
+        artifacts = []
+        for aid, type, pid in [
+            ("a1", "Analyte", None),
+            ("a2", "Analyte", "p1"),
+            ("a3", "Analyte", "p2"),
+            ("r1", "ResultFile", "p3"),
+        ]:
+            parent = ""
+            if pid:
+                parent = f'<parent-process uri="{url}/api/v2/processes/{pid}"/>'
+            artifact = Artifact(self.lims, id=aid)
+            artifact.root = ElementTree.fromstring(
+                generic_artifact_xml.format(url=url, aid=aid, type=type, parent=parent)
+            )
+            artifacts.append(artifact)
+        processes = []
+        for pid, tid, name, day, maps in [
+            ("p1", "1", "Library prep", 1, [("a1", "a2", "Analyte")]),
+            ("p2", "2", "Pooling", 2, [("a2", "a3", "Analyte")]),
+            ("p3", "3", "QC", 3, [("a2", "r1", "ResultFile")]),
+        ]:
+            process = Process(self.lims, id=pid)
+            maps_xml = "\n".join(
+                generic_map_xml.format(url=url, input=i, output=o, type=t)
+                for i, o, t in maps
+            )
+            process.root = ElementTree.fromstring(
+                generic_process_xml.format(
+                    url=url, pid=pid, tid=tid, name=name, day=day, maps=maps_xml
+                )
+            )
+            processes.append(process)
+        self.genealogy = Genealogy(self.lims)
+        self.genealogy.add_artifacts(artifacts)
+        self.genealogy.add_processes(processes)
+
+    def test_lineage(self):
+        assert self.genealogy.parents("a3") == ["a2"]
+        assert sorted(self.genealogy.children("a2")) == ["a3", "r1"]
+        assert sorted(self.genealogy.ancestors("a3")) == ["a1", "a2"]
+        assert sorted(self.genealogy.descendants("a1")) == ["a2", "a3", "r1"]
+        assert self.genealogy.path("a1", "a3") == ["a1", "a2", "a3"]
+        assert self.genealogy.path("a3", "a1") is None
+
+    def test_sample_history(self):
+        history, history_list = self.genealogy.sample_history("S1", "a3")
+        assert history_list == ["a2", "a1"]
+        assert history["a2"]["p2"]["outart"] == "a3"
+        assert history["a2"]["p3"]["outart"] is None
+        assert history["a2"]["p3"]["name"] == "QC"
+        assert history["a1"]["p1"] == {
+            "date": "2024-01-01",
+            "id": "p1",
+            "outart": "a2",
+            "inart": "a1",
+            "type": "1",
+            "name": "Library prep",
+        }
+        assert self.genealogy.process_history("a3", "S1") == ["p2", "p1"]
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "genealogy.json")
+            self.genealogy.save(path)
+            loaded = Genealogy.load(self.lims, path)
+        assert loaded.sample_history("S1", "a3") == self.genealogy.sample_history(
+            "S1", "a3"
+        )
+
+    def test_processes_per_artifact(self):
+        pro_per_art = self.genealogy.processes_per_artifact()
+        assert sorted(p.id for p in pro_per_art["a2"]) == ["p2", "p3"]
+        assert pro_per_art["a3"] == []
+        assert self.genealogy.sample_artifact_map("S1") == {
+            "a2": (Process(self.lims, id="p1"), "a1"),
+            "a3": (Process(self.lims, id="p2"), "a2"),
+        }
+
+    def test_build_processes_per_artifact(self):
+        lims = self.lims
+        artifacts = [Artifact(lims, id=aid) for aid in ("a1", "a2", "a3", "r1")]
+        processes = [Process(lims, id=pid) for pid in ("p1", "p2", "p3")]
+        with (
+            patch.object(lims, "get_samples", return_value=[Sample(lims, id="s1")]),
+            patch.object(lims, "get_artifacts", return_value=artifacts),
+            patch.object(lims, "get_processes", return_value=processes) as get_procs,
+        ):
+            pro_per_art, art_maps = build_processes_per_artifact(
+                lims, project=Project(lims, id="p")
+            )
+        assert get_procs.call_count == 1
+        assert sorted(get_procs.call_args[1]["inputartifactlimsid"]) == [
+            "a1",
+            "a2",
+            "a3",
+            "r1",
+        ]
+        for tid, name in [("1", "Library prep"), ("2", "Pooling"), ("3", "QC")]:
+            with patch.object(
+                lims,
+                "get",
+                return_value=ElementTree.fromstring(
+                    processtype_xml.format(url=url, tid=tid, name=name)
+                ),
+            ):
+                Processtype(lims, id=tid)
+        with patch.object(lims, "get_artifacts", return_value=artifacts[:3]):
+            history = SampleHistory(
+                sample_name="S1",
+                output_artifact="a3",
+                lims=lims,
+                pro_per_art=pro_per_art,
+                test=True,
+            )
+        assert history.art_map == art_maps["S1"]
+        assert history.history_list == ["a2", "a1"]
+        assert history.history["a2"]["p3"]["outart"] is None
@@ -1,7 +1,11 @@
+import threading
+import time
 from unittest import TestCase
+from xml.etree import ElementTree
 
 from requests.exceptions import HTTPError
 
+from genologics.entities import Artifact, Process, Researcher, Sample, StepDetails
 from genologics.lims import Lims
 
 try:
@@ -17,6 +21,17 @@ import builtins
 from unittest.mock import Mock, patch
 
 
+def fake_get_batch(make_root):
+    "Return a stand-in for Lims.get_batch setting each root to make_root(instance)."
+
+    def get_batch(instances, force=False):
+        for instance in instances:
+            instance.root = make_root(instance)
+        return instances
+
+    return get_batch
+
+
 class TestLims(TestCase):
     url = "http://testgenologics.com:4040"
     username = "test"
@@ -34,6 +49,26 @@ class TestLims(TestCase):
 <exc:exception xmlns:exc="http://genologics.com/ri/exception">
 </exc:exception>"""
 
+    artifact_xml = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" xmlns:udf="http://genologics.com/ri/userdefined" limsid="{id}">
+<name>{id}</name><udf:field type="Numeric" name="Conc">1</udf:field></art:artifact>"""
+    researcher_xml = """<res:researcher xmlns:res="http://genologics.com/ri/researcher">
+<first-name>Jane</first-name><last-name>Doe</last-name></res:researcher>"""
+
+    workflows_xml = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<wkfcnf:workflows xmlns:wkfcnf="http://genologics.com/ri/workflowconfiguration">
+    <workflow status="ACTIVE" uri="{url}/api/v2/configuration/workflows/1" name="wf1"/>
+</wkfcnf:workflows>
+"""
+    workflow_xml = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<wkfcnf:workflow xmlns:wkfcnf="http://genologics.com/ri/workflowconfiguration" status="ACTIVE" uri="{url}/api/v2/configuration/workflows/1" name="wf1">
+    <protocols/>
+    <stages/>
+</wkfcnf:workflow>
+"""
+
+    def artifact_root(self, instance):
+        return ElementTree.fromstring(self.artifact_xml.format(id=instance.id))
+
     def test_get_uri(self):
         lims = Lims(self.url, username=self.username, password=self.password)
         assert (
@@ -77,12 +112,14 @@ class TestLims(TestCase):
         lims = Lims(self.url, username=self.username, password=self.password)
         uri = f"{self.url}/api/v2/samples/test_sample"
         with patch(
-            "requests.put", return_value=Mock(content=self.sample_xml, status_code=200)
+            "requests.Session.put",
+            return_value=Mock(content=self.sample_xml, status_code=200),
         ) as mocked_put:
             lims.put(uri=uri, data=self.sample_xml)
             assert mocked_put.call_count == 1
         with patch(
-            "requests.put", return_value=Mock(content=self.error_xml, status_code=400)
+            "requests.Session.put",
+            return_value=Mock(content=self.error_xml, status_code=400),
         ) as mocked_put:
             self.assertRaises(HTTPError, lims.put, uri=uri, data=self.sample_xml)
             assert mocked_put.call_count == 1
@@ -91,12 +128,14 @@ class TestLims(TestCase):
         lims = Lims(self.url, username=self.username, password=self.password)
         uri = f"{self.url}/api/v2/samples"
         with patch(
-            "requests.post", return_value=Mock(content=self.sample_xml, status_code=200)
+            "requests.Session.post",
+            return_value=Mock(content=self.sample_xml, status_code=200),
         ) as mocked_put:
             lims.post(uri=uri, data=self.sample_xml)
             assert mocked_put.call_count == 1
         with patch(
-            "requests.post", return_value=Mock(content=self.error_xml, status_code=400)
+            "requests.Session.post",
+            return_value=Mock(content=self.error_xml, status_code=400),
         ) as mocked_put:
             self.assertRaises(HTTPError, lims.post, uri=uri, data=self.sample_xml)
             assert mocked_put.call_count == 1
@@ -119,7 +158,7 @@ class TestLims(TestCase):
             [xml_intro, file_start2, attached, upload, content_loc, file_end]
         ).format(url=self.url)
         with patch(
-            "requests.post",
+            "requests.Session.post",
             side_effect=[
                 Mock(content=glsstorage_xml, status_code=200),
                 Mock(content=file_post_xml, status_code=200),
@@ -132,7 +171,8 @@ class TestLims(TestCase):
             assert file.id == "40-3501"
 
         with patch(
-            "requests.post", side_effect=[Mock(content=self.error_xml, status_code=400)]
+            "requests.Session.post",
+            side_effect=[Mock(content=self.error_xml, status_code=400)],
         ):
             self.assertRaises(
                 HTTPError,
@@ -141,7 +181,9 @@ class TestLims(TestCase):
                 "filename_to_upload",
             )
 
-    @patch("requests.post", return_value=Mock(content=sample_xml, status_code=200))
+    @patch(
+        "requests.Session.post", return_value=Mock(content=sample_xml, status_code=200)
+    )
     def test_route_artifact(self, mocked_post):
         lims = Lims(self.url, username=self.username, password=self.password)
         artifact = Mock(uri=self.url + "/artifact/2")
@@ -164,3 +206,299 @@ class TestLims(TestCase):
 <a><b /><c><d /></c></a>"""
         string = lims.tostring(etree)
         assert string == expected_string
+
+    def test_get_instances_summary(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        with patch(
+            "requests.Session.get",
+            return_value=Mock(content=self.workflows_xml, status_code=200),
+        ) as mocked_get:
+            workflows, info = lims.get_workflows(add_info=True)
+            assert info == [
+                {
+                    "status": "ACTIVE",
+                    "uri": f"{self.url}/api/v2/configuration/workflows/1",
+                    "name": "wf1",
+                }
+            ]
+            assert workflows[0].name == "wf1"
+            assert workflows[0].status == "ACTIVE"
+            assert workflows[0].root is None
+            assert mocked_get.call_count == 1
+        with patch(
+            "requests.Session.get",
+            return_value=Mock(content=self.workflow_xml, status_code=200),
+        ) as mocked_get:
+            assert workflows[0].stages == []
+            assert mocked_get.call_count == 1
+            assert workflows[0].name == "wf1"
+
+    def test_prefetch(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        xml = {
+            "artifacts/a1": '<art:artifact xmlns:art="http://genologics.com/ri/artifact" limsid="a1"><sample uri="{url}/api/v2/samples/s1" limsid="s1"/></art:artifact>',
+            "artifacts/a2": '<art:artifact xmlns:art="http://genologics.com/ri/artifact" limsid="a2"><sample uri="{url}/api/v2/samples/s1" limsid="s1"/></art:artifact>',
+            "samples/s1": '<smp:sample xmlns:smp="http://genologics.com/ri/sample" limsid="s1"><project uri="{url}/api/v2/projects/p1" limsid="p1"/></smp:sample>',
+            "projects/p1": '<prj:project xmlns:prj="http://genologics.com/ri/project" limsid="p1"><name>P1</name></prj:project>',
+        }
+
+        def root(uri):
+            key = uri.split("/api/v2/")[1]
+            return ElementTree.fromstring(xml[key].format(url=self.url))
+
+        get_batch = fake_get_batch(lambda instance: root(instance.uri))
+
+        artifacts = [
+            Artifact(lims, id="a1"),
+            Artifact(lims, id="a2"),
+        ]
+        with (
+            patch.object(lims, "get_batch", side_effect=get_batch) as mocked_batch,
+            patch.object(lims, "get", side_effect=root) as mocked_get,
+        ):
+            lims.prefetch(artifacts, "samples.project")
+            assert mocked_batch.call_count == 2
+            assert mocked_get.call_count == 1
+            assert artifacts[0].samples[0].project.name == "P1"
+
+    def test_get_many(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+
+        def get(uri, *args, **kwargs):
+            if uri.endswith("/r3"):
+                return Mock(content=self.error_xml, status_code=404)
+            return Mock(content=self.researcher_xml, status_code=200)
+
+        researchers = [Researcher(lims, id=id) for id in ("r1", "r2", "r3")]
+        researchers[1].root = ElementTree.fromstring(self.researcher_xml)
+        with patch("requests.Session.get", side_effect=get) as mocked_get:
+            failures = lims.get_many(researchers, max_workers=2)
+            assert mocked_get.call_count == 2
+        assert list(failures) == [researchers[2]]
+        assert isinstance(failures[researchers[2]], HTTPError)
+        assert researchers[0].name == "Jane Doe"
+        assert researchers[2].root is None
+
+    def test_batch_on_miss(self):
+        lims = Lims(
+            self.url, username=self.username, password=self.password, batch_on_miss=2
+        )
+        artifacts_xml = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<art:artifacts xmlns:art="http://genologics.com/ri/artifact">
+    <artifact uri="{self.url}/api/v2/artifacts/a1" limsid="a1"/>
+    <artifact uri="{self.url}/api/v2/artifacts/a2" limsid="a2"/>
+    <artifact uri="{self.url}/api/v2/artifacts/a3" limsid="a3"/>
+</art:artifacts>
+"""
+
+        get_batch = fake_get_batch(self.artifact_root)
+
+        with patch(
+            "requests.Session.get",
+            return_value=Mock(content=artifacts_xml, status_code=200),
+        ):
+            artifacts = lims.get_artifacts()
+        with patch.object(lims, "get_batch", side_effect=get_batch) as mocked_batch:
+            assert [a.name for a in artifacts] == ["a1", "a2", "a3"]
+            assert mocked_batch.call_count == 2
+            assert mocked_batch.call_args_list[0][0][0] == artifacts[:2]
+
+        # Members of a window accessed concurrently are loaded by one call
+        with patch(
+            "requests.Session.get",
+            return_value=Mock(content=artifacts_xml, status_code=200),
+        ):
+            lims.cache.clear()
+            artifacts = lims.get_artifacts()
+
+        def slow_get_batch(instances, force=False):
+            time.sleep(0.1)
+            return get_batch(instances)
+
+        with patch.object(
+            lims, "get_batch", side_effect=slow_get_batch
+        ) as mocked_batch:
+            threads = [
+                threading.Thread(target=artifact.get) for artifact in artifacts[:2]
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert mocked_batch.call_count == 1
+            assert artifacts[1].root is not None
+
+    def test_unit_of_work(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        artifacts = []
+        for id in ("a1", "a2", "a3"):
+            artifact = Artifact(lims, id=id)
+            artifact.root = self.artifact_root(artifact)
+            artifacts.append(artifact)
+        researchers = [Researcher(lims, id=id) for id in ("r1", "r2")]
+        for researcher in researchers:
+            researcher.root = ElementTree.fromstring(self.researcher_xml)
+
+        def put(uri, *args, **kwargs):
+            if uri.endswith("/r2"):
+                raise HTTPError("Conflict")
+
+        with (
+            patch.object(lims, "post") as mocked_post,
+            patch.object(lims, "put", side_effect=put) as mocked_put,
+        ):
+            with lims.unit_of_work(max_workers=2) as unit:
+                artifacts[0].udf["Conc"] = 2
+                artifacts[1].udf["Conc"] = 3
+                artifacts[2].udf["Conc"] = 1
+                researchers[0].first_name = "John"
+                researchers[1].put(force=True)
+                assert mocked_put.call_count == 0
+            assert mocked_post.call_count == 1
+            batch = ElementTree.fromstring(mocked_post.call_args[0][1])
+            assert [node.attrib["limsid"] for node in batch] == ["a1", "a2"]
+            assert mocked_put.call_count == 2
+        assert list(unit.failures) == [researchers[1]]
+        assert not artifacts[0].is_modified()
+
+        with patch.object(lims, "put") as mocked_put:
+            with self.assertRaises(ValueError):
+                with lims.unit_of_work():
+                    researchers[0].first_name = "Jim"
+                    raise ValueError
+            assert mocked_put.call_count == 0
+            assert lims._unit_of_work is None
+
+        # Puts of other threads are not deferred into the unit
+        with patch.object(lims, "put") as mocked_put:
+            with self.assertRaises(ValueError):
+                with lims.unit_of_work():
+                    researchers[0].first_name = "Jim"
+                    thread = threading.Thread(target=researchers[1].put, args=(True,))
+                    thread.start()
+                    thread.join()
+                    raise ValueError
+            assert mocked_put.call_count == 1
+
+    def test_update_udfs(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+
+        artifacts = [Artifact(lims, id=id) for id in ("a1", "a2", "a3")]
+        with (
+            patch.object(
+                lims, "get_batch", side_effect=fake_get_batch(self.artifact_root)
+            ) as mocked_batch,
+            patch.object(lims, "post") as mocked_post,
+        ):
+            outcomes = lims.update_udfs(
+                entities=artifacts,
+                names=["Conc", "Comment"],
+                values=[[2, 1, "high"], ["ok", "ok", "ok"]],
+            )
+            assert mocked_batch.call_count == 1
+            assert mocked_post.call_count == 1
+            batch = ElementTree.fromstring(mocked_post.call_args[0][1])
+            assert [node.attrib["limsid"] for node in batch] == ["a1", "a2"]
+        assert outcomes[artifacts[0]] is None
+        assert isinstance(outcomes[artifacts[2]], TypeError)
+        assert dict(artifacts[0].udf.items()) == {"Conc": 2, "Comment": "ok"}
+        assert artifacts[2].udf["Conc"] == 1
+        assert "Comment" not in artifacts[2].udf
+
+        with patch.object(lims, "post") as mocked_post:
+            outcomes = lims.update_udfs({artifacts[1]: {"Conc": 1.5}})
+            assert mocked_post.call_count == 1
+        assert outcomes == {artifacts[1]: None}
+        assert artifacts[1].udf["Conc"] == 1.5
+
+        # Step details keep their UDFs in a fields element
+        details = StepDetails(lims, uri=self.url + "/api/v2/steps/s1/details")
+        details.root = ElementTree.fromstring(
+            """<stp:details xmlns:stp="http://genologics.com/ri/step" xmlns:udf="http://genologics.com/ri/userdefined">
+<fields><udf:field type="Numeric" name="Temp">20</udf:field></fields></stp:details>"""
+        )
+        with patch.object(lims, "put") as mocked_put:
+            outcomes = lims.update_udfs({details: {"Temp": 21, "Operator": "JD"}})
+            assert mocked_put.call_count == 1
+        assert outcomes == {details: None}
+        fields = details.root.find("fields")
+        assert len(fields) == 2
+        assert len(details.root) == 1
+        assert dict(details.udf.items()) == {"Temp": 21, "Operator": "JD"}
+
+    def test_invalidate(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        artifacts = [Artifact(lims, id=id) for id in ("a1", "a2")]
+        for artifact in artifacts:
+            artifact.root = self.artifact_root(artifact)
+        artifacts[1].name = "changed"
+
+        with patch(
+            "requests.Session.post",
+            return_value=Mock(content=self.sample_xml, status_code=200),
+        ):
+            lims.route_artifacts(artifacts, stage_uri=self.url + "/stages/1")
+        assert artifacts[0].root is None
+        assert artifacts[1].name == "changed"
+        assert lims.stale == {artifacts[0].uri}
+
+        with patch.object(
+            lims, "get_batch", side_effect=fake_get_batch(self.artifact_root)
+        ) as mocked_batch:
+            assert lims.refresh_stale() == {}
+            assert mocked_batch.call_count == 1
+        assert artifacts[0].name == "a1"
+        assert lims.stale == set()
+
+    def test_processes_by_input(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        process_xml = """<prc:process xmlns:prc="http://genologics.com/ri/process" limsid="{id}">
+<input-output-map>
+<input uri="{url}/api/v2/artifacts/{input}" limsid="{input}"/>
+<output uri="{url}/api/v2/artifacts/o-{id}" limsid="o-{id}" output-type="Analyte"/>
+</input-output-map>
+</prc:process>"""
+        processes = []
+        for id, input in [("p1", "a1"), ("p2", "a1"), ("p3", "a2")]:
+            process = Process(lims, id=id)
+            process.root = ElementTree.fromstring(
+                process_xml.format(url=self.url, id=id, input=input)
+            )
+            processes.append(process)
+        artifacts = [Artifact(lims, id=id) for id in ("a1", "a2", "a3")]
+        with patch.object(lims, "get_processes", return_value=processes) as mocked:
+            result = lims.processes_by_input(artifacts)
+            assert mocked.call_count == 1
+            assert mocked.call_args[1]["inputartifactlimsid"] == ["a1", "a2", "a3"]
+        assert result == {
+            artifacts[0]: processes[:2],
+            artifacts[1]: processes[2:],
+            artifacts[2]: [],
+        }
+
+    def test_artifacts_by_sample(self):
+        lims = Lims(self.url, username=self.username, password=self.password)
+        artifact_xml = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" limsid="{id}">
+{samples}</art:artifact>"""
+        artifacts = []
+        for id, sample_ids in [("a1", ["s1"]), ("a2", ["s1", "s2"])]:
+            samples = "".join(
+                f'<sample uri="{self.url}/api/v2/samples/{s}" limsid="{s}"/>'
+                for s in sample_ids
+            )
+            artifact = Artifact(lims, id=id)
+            artifact.root = ElementTree.fromstring(
+                artifact_xml.format(id=id, samples=samples)
+            )
+            artifacts.append(artifact)
+        samples = [Sample(lims, id=id) for id in ("s1", "s2", "s3")]
+        with patch.object(lims, "get_artifacts", return_value=artifacts) as mocked:
+            result = lims.artifacts_by_sample(samples, type="Analyte")
+            assert mocked.call_count == 1
+            assert mocked.call_args[1]["samplelimsid"] == ["s1", "s2", "s3"]
+            assert mocked.call_args[1]["type"] == "Analyte"
+        assert result == {
+            samples[0]: artifacts,
+            samples[1]: artifacts[1:],
+            samples[2]: [],
+        }
@@ -0,0 +1,109 @@
+from unittest import TestCase
+from unittest.mock import patch
+from xml.etree import ElementTree
+
+from genologics.entities import Artifact, Container, Process, Project, Sample
+from genologics.lims import Lims
+from genologics.mirror import SqliteMirror
+
+url = "http://testgenologics.com:4040"
+
+sample_xml = """<smp:sample xmlns:smp="http://genologics.com/ri/sample" xmlns:udf="http://genologics.com/ri/userdefined" uri="{url}/api/v2/samples/{id}" limsid="{id}">
+<name>{name}</name>
+<project uri="{url}/api/v2/projects/p1" limsid="p1"/>
+<udf:field type="Numeric" name="Conc">{conc}</udf:field>
+</smp:sample>"""
+
+artifact_xml = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" uri="{url}/api/v2/artifacts/{id}" limsid="{id}">
+<name>{id}</name>
+<type>Analyte</type>
+<qc-flag>PASSED</qc-flag>
+<location><container uri="{url}/api/v2/containers/c1" limsid="c1"/><value>{well}</value></location>
+<sample uri="{url}/api/v2/samples/{sample}" limsid="{sample}"/>
+</art:artifact>"""
+
+process_xml = """<prc:process xmlns:prc="http://genologics.com/ri/process" uri="{url}/api/v2/processes/pr1" limsid="pr1">
+<type uri="{url}/api/v2/processtypes/1">Library prep</type>
+<date-run>2024-01-01</date-run>
+<input-output-map>
+<input uri="{url}/api/v2/artifacts/a1" limsid="a1"/>
+<output uri="{url}/api/v2/artifacts/a2" limsid="a2" output-type="Analyte"/>
+</input-output-map>
+</prc:process>"""
+
+container_xml = """<con:container xmlns:con="http://genologics.com/ri/container" uri="{url}/api/v2/containers/c1" limsid="c1">
+<name>Plate 1</name>
+<type uri="{url}/api/v2/containertypes/1" name="96 well plate"/>
+<placement uri="{url}/api/v2/artifacts/a1" limsid="a1"><value>A:1</value></placement>
+<placement uri="{url}/api/v2/artifacts/a2" limsid="a2"><value>B:1</value></placement>
+<state>Populated</state>
+</con:container>"""
+
+
+class TestSqliteMirror(TestCase):
+    def setUp(self):
+        self.lims = Lims(url, username="test", password="password")
+        self.samples = []
+        for id, name, conc in [("s1", "S1", 2), ("s2", "S2", 8)]:
+            sample = Sample(self.lims, id=id)
+            sample.root = ElementTree.fromstring(
+                sample_xml.format(url=url, id=id, name=name, conc=conc)
+            )
+            self.samples.append(sample)
+        self.artifacts = []
+        for id, well in [("a1", "A:1"), ("a2", "B:1")]:
+            artifact = Artifact(self.lims, id=id)
+            artifact.root = ElementTree.fromstring(
+                artifact_xml.format(url=url, id=id, well=well, sample="s1")
+            )
+            self.artifacts.append(artifact)
+        self.process = Process(self.lims, id="pr1")
+        self.process.root = ElementTree.fromstring(process_xml.format(url=url))
+        self.container = Container(self.lims, id="c1")
+        self.container.root = ElementTree.fromstring(container_xml.format(url=url))
+
+    def test_queries(self):
+        mirror = SqliteMirror(self.lims)
+        mirror.add(self.samples + self.artifacts + [self.process, self.container])
+        assert mirror.samples_by_udf("Conc", ">", 5) == [self.samples[1]]
+        assert mirror.samples_by_udf("Conc", "<=", 5, project_id="p1") == [
+            self.samples[0]
+        ]
+        assert mirror.samples_by_udf("Conc", ">", 5, project_id="p2") == []
+        with self.assertRaises(ValueError):
+            mirror.samples_by_udf("Conc", "; DROP", 5)
+        assert mirror.artifacts_of_sample("s1", type="Analyte") == self.artifacts
+        assert mirror.artifacts_in_container("c1") == {
+            "A:1": self.artifacts[0],
+            "B:1": self.artifacts[1],
+        }
+        assert mirror.processes_using("a1") == [self.process]
+        rows = mirror.rows("SELECT name, type_name FROM containers")
+        assert [tuple(row) for row in rows] == [("Plate 1", "96 well plate")]
+
+    def test_offline_entities(self):
+        mirror = SqliteMirror(self.lims)
+        mirror.add(self.samples)
+        lims = Lims(url, username="test", password="password")
+        offline = SqliteMirror(lims)
+        offline.connection = mirror.connection
+        with patch("requests.Session.get") as mocked_get:
+            (sample,) = offline.samples_by_udf("Conc", "=", 8)
+            assert sample.name == "S2"
+            assert sample.udf["Conc"] == 8
+            assert mocked_get.call_count == 0
+
+    def test_load_project(self):
+        mirror = SqliteMirror(self.lims)
+        with (
+            patch.object(self.lims, "get_samples", return_value=self.samples),
+            patch.object(self.lims, "get_artifacts", return_value=self.artifacts),
+            patch.object(self.lims, "get_processes", return_value=[self.process]),
+            patch.object(self.lims, "get") as mocked_get,
+        ):
+            mirror.load_project(Project(self.lims, id="p1"))
+            assert mocked_get.call_count == 0
+        assert [tuple(r) for r in mirror.rows("SELECT id FROM processes")] == [("pr1",)]
+        assert len(mirror.rows("SELECT * FROM placements")) == 2
+        mirror.set_mark("samples", "2024-01-01T00:00:00.000Z")
+        assert mirror.get_mark("samples") == "2024-01-01T00:00:00.000Z"
@@ -0,0 +1,273 @@
+import time
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from urllib.parse import urlencode
+from xml.etree import ElementTree
+
+import requests
+
+from genologics.entities import Artifact, Sample
+from genologics.lims import MAX_QUERY_LENGTH, Lims, _split_params
+from genologics.query import QueryCache
+
+url = "http://testgenologics.com:4040"
+
+samples_page_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<smp:samples xmlns:smp="http://genologics.com/ri/sample">
+{samples}
+{next_page}
+</smp:samples>"""
+
+
+def samples_page(ids, next_index=None):
+    samples = "\n".join(
+        f'<sample uri="{url}/api/v2/samples/{id}" limsid="{id}"><name>{id}</name></sample>'
+        for id in ids
+    )
+    next_page = ""
+    if next_index is not None:
+        next_page = f'<next-page uri="{url}/api/v2/samples?start-index={next_index}"/>'
+    return Mock(
+        content=samples_page_xml.format(samples=samples, next_page=next_page),
+        status_code=200,
+    )
+
+
+def fake_get_batch(make_root):
+    "Return a stand-in for Lims.get_batch setting each root to make_root(instance)."
+
+    def get_batch(instances, force=False):
+        for instance in instances:
+            instance.root = make_root(instance)
+        return instances
+
+    return get_batch
+
+
+class TestQuery(TestCase):
+    def setUp(self):
+        self.lims = Lims(url, username="test", password="password")
+        self.pages = [
+            samples_page(["s1", "s2"], next_index=2),
+            samples_page(["s3", "s4"], next_index=4),
+            samples_page(["s5"]),
+        ]
+
+    def test_filter(self):
+        query = self.lims.samples.filter(name="S1", udf={"Conc": 1})
+        assert query.params == {"name": "S1", "udf.Conc": 1}
+        assert self.lims.samples.params == {}
+        with patch("requests.Session.get", side_effect=self.pages) as mocked_get:
+            assert [s.name for s in query] == ["s1", "s2", "s3", "s4", "s5"]
+            assert mocked_get.call_count == 3
+            assert mocked_get.call_args_list[0][1]["params"] == query.params
+
+    def test_early_termination(self):
+        with patch("requests.Session.get", side_effect=self.pages) as mocked_get:
+            assert self.lims.samples.first() == Sample(self.lims, id="s1")
+            assert mocked_get.call_count == 1
+        with patch("requests.Session.get", side_effect=self.pages) as mocked_get:
+            assert self.lims.samples.exists()
+            assert mocked_get.call_count == 1
+        with patch("requests.Session.get", side_effect=self.pages) as mocked_get:
+            samples = list(self.lims.samples.limit(3))
+            assert [s.id for s in samples] == ["s1", "s2", "s3"]
+            assert mocked_get.call_count == 2
+
+    def get_page(self, uri, params=None, **kwargs):
+        index = params.get("start-index", 0) // 2
+        if index >= len(self.pages):
+            return samples_page([])
+        return self.pages[index]
+
+    def test_count(self):
+        with patch("requests.Session.get", side_effect=self.get_page) as mocked_get:
+            assert self.lims.samples.count(max_workers=2) == 5
+            # The second page alone, then up to two pages at a time
+            assert mocked_get.call_count <= 4
+            start_indexes = [
+                c[1]["params"].get("start-index") for c in mocked_get.call_args_list
+            ]
+            assert start_indexes[1:3] == [2, 4]
+        with patch("requests.Session.get", side_effect=self.get_page):
+            assert self.lims.get_sample_number(projectname="P1") == 5
+            assert self.lims.count_samples(projectname="P1") == 5
+        with patch("requests.Session.get", side_effect=self.pages):
+            assert self.lims.samples.limit(3).count() == 3
+        with patch("requests.Session.get", side_effect=self.get_page):
+            counts = self.lims.count_many(
+                [
+                    self.lims.samples,
+                    self.lims.samples.filter(name="s1"),
+                    self.lims.samples.limit(3),
+                ]
+            )
+            assert counts == [5, 5, 3]
+        with patch("requests.Session.get", side_effect=[samples_page([])]):
+            assert not self.lims.samples.exists()
+
+    def test_count_two_pages(self):
+        def get(uri, params=None, **kwargs):
+            if params.get("start-index") is None:
+                return samples_page(["s1", "s2"], 2)
+            return samples_page(["s3"])
+
+        with patch("requests.Session.get", side_effect=get) as mocked_get:
+            assert self.lims.get_sample_number(projectname="P1") == 3
+            assert mocked_get.call_count == 2
+        with patch("requests.Session.get", side_effect=get) as mocked_get:
+            queries = [self.lims.samples.filter(projectlimsid=id) for id in "ABC"]
+            assert self.lims.count_many(queries) == [3, 3, 3]
+            assert mocked_get.call_count == 6
+
+    def test_start_index(self):
+        with patch("requests.Session.get", side_effect=self.pages[1:]) as mocked_get:
+            samples = self.lims.get_samples(start_index=2)
+            assert [s.id for s in samples] == ["s3", "s4"]
+            assert mocked_get.call_count == 1
+
+    def test_resolve(self):
+        get_batch = fake_get_batch(lambda instance: instance._summary)
+
+        with (
+            patch("requests.Session.get", side_effect=self.pages),
+            patch.object(self.lims, "get_batch", side_effect=get_batch) as batch,
+        ):
+            samples = self.lims.samples.limit(2).resolve()
+            assert batch.call_count == 1
+        assert [s.root is not None for s in samples] == [True, True]
+
+    def test_split_params(self):
+        ids = [f"2-{i:06d}" for i in range(1000)]
+        chunks = _split_params({"type": "Analyte", "samplelimsid": ids}, 1000)
+        assert len(chunks) > 1
+        assert all(len(urlencode(c, doseq=True)) <= 1000 for c in chunks)
+        assert all(c["type"] == "Analyte" for c in chunks)
+        assert [i for c in chunks for i in c["samplelimsid"]] == ids
+        assert _split_params({"name": ids[:2]}, 1000) == [{"name": ids[:2]}]
+
+    def test_long_query(self):
+        names = [f"s{i}" for i in range(5)]
+
+        def get(uri, params=None, **kwargs):
+            # Every sub-query also returns s1, to be deduplicated
+            return samples_page(sorted(set(params["name"]) | {"s1"}))
+
+        with (
+            patch("genologics.lims.MAX_QUERY_LENGTH", 20),
+            patch("requests.Session.get", side_effect=get) as mocked_get,
+        ):
+            samples = self.lims.get_samples(name=names)
+            assert mocked_get.call_count > 1
+            assert sorted(s.id for s in samples) == names
+            assert self.lims.samples.filter(name=names).count() == 5
+
+    def test_long_query_pages(self):
+        ids = [f"2-{i:06d}" for i in range(2000)]
+        lengths = []
+
+        def get(uri, params=None, **kwargs):
+            lengths.append(
+                len(requests.Request("GET", uri, params=params).prepare().url)
+            )
+            if "start-index" in uri:
+                return samples_page([])
+            # The next-page URI repeats the filters, as the LIMS does
+            query = urlencode(params, doseq=True).replace("&", "&amp;")
+            page = samples_page(params["name"][:1])
+            page.content = page.content.replace(
+                "</smp:samples>",
+                f'<next-page uri="{url}/api/v2/samples?{query}&amp;start-index=1"/>'
+                "</smp:samples>",
+            )
+            return page
+
+        with patch("requests.Session.get", side_effect=get):
+            self.lims.get_samples(name=ids)
+        assert len(lengths) > 2
+        assert max(lengths) < MAX_QUERY_LENGTH + 100
+
+
+class TestQueryCache(TestCase):
+    def test_cache(self):
+        cache = QueryCache(ttl=60)
+        lims = Lims(url, username="test", password="password", query_cache=cache)
+        with patch(
+            "requests.Session.get", side_effect=lambda *a, **k: samples_page(["s1"])
+        ) as mocked_get:
+            first = lims.get_samples(name=["a", "b"])
+            assert lims.get_samples(name=["b", "a"]) == first
+            assert mocked_get.call_count == 1
+            lims.get_samples(name="c")
+            assert mocked_get.call_count == 2
+            cache.invalidate(Sample)
+            lims.get_samples(name=["a", "b"])
+            assert mocked_get.call_count == 3
+        assert cache.stats() == {
+            "hits": 1,
+            "misses": 3,
+            "entries": 1,
+            "hit_rate": 0.25,
+        }
+
+    def test_invalidated_by_writes(self):
+        cache = QueryCache(ttl=60)
+        lims = Lims(url, username="test", password="password", query_cache=cache)
+        sample_key = cache.key(Sample, {"name": "a"})
+        artifact_key = cache.key(Artifact, {"name": "a"})
+        cache.set(sample_key, ([], []))
+        cache.set(artifact_key, ([], []))
+        sample = Sample(lims, id="s1")
+        sample.root = ElementTree.fromstring("<sample><name>s1</name></sample>")
+        sample.name = "renamed"
+        with patch.object(lims, "put"):
+            assert sample.put()
+        assert cache.get(sample_key) is None
+        assert cache.get(artifact_key) is not None
+        lims.invalidate([Artifact(lims, id="a1")])
+        assert cache.get(artifact_key) is None
+
+    def test_ttl(self):
+        cache = QueryCache(ttl=60)
+        key = cache.key(Sample, {"name": "a"})
+        cache.set(key, ([], []))
+        assert cache.get(key) == ([], [])
+        with patch(
+            "genologics.query.time.monotonic", return_value=time.monotonic() + 61
+        ):
+            assert cache.get(key) is None
+        assert cache.stats()["entries"] == 0
+
+
+class TestResolve(TestCase):
+    def test_get_artifacts_resolve(self):
+        lims = Lims(url, username="test", password="password")
+        pages = []
+        for ids, next_index in [(["a1", "a2"], 2), (["a3", "a2"], None)]:
+            artifacts = "\n".join(
+                f'<artifact uri="{url}/api/v2/artifacts/{id}?state=1" limsid="{id}"/>'
+                for id in ids
+            )
+            next_page = ""
+            if next_index is not None:
+                next_page = f'<next-page uri="{url}/api/v2/artifacts?start-index={next_index}"/>'
+            pages.append(
+                Mock(
+                    content=f'<art:artifacts xmlns:art="http://genologics.com/ri/artifact">{artifacts}{next_page}</art:artifacts>',
+                    status_code=200,
+                )
+            )
+
+        get_batch = fake_get_batch(
+            lambda instance: ElementTree.fromstring(
+                f"<artifact><name>{instance.id}</name></artifact>"
+            )
+        )
+
+        with (
+            patch("requests.Session.get", side_effect=pages),
+            patch.object(lims, "get_batch", side_effect=get_batch) as mocked_batch,
+        ):
+            artifacts = lims.get_artifacts(type="Analyte", resolve=True)
+            assert mocked_batch.call_count == 2
+        assert [a.name for a in artifacts] == ["a1", "a2", "a3"]
@@ -0,0 +1,92 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from xml.etree import ElementTree
+
+from genologics.entities import Project, Sample
+from genologics.lims import Lims
+from genologics.query import QueryCache
+from genologics.sync import DeltaSync, MemoryStore
+
+url = "http://testgenologics.com:4040"
+
+projects_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<prj:projects xmlns:prj="http://genologics.com/ri/project">
+{projects}
+</prj:projects>"""
+
+project_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<prj:project xmlns:prj="http://genologics.com/ri/project" uri="{url}/api/v2/projects/{id}" limsid="{id}">
+<name>{name}</name>
+</prj:project>"""
+
+
+class TestDeltaSync(TestCase):
+    def setUp(self):
+        self.lims = Lims(url, username="test", password="password")
+        self.modified = ["p1", "p2"]
+        self.names = {"p1": "P1", "p2": "P2"}
+
+    def get(self, uri, params=None, **kwargs):
+        if uri.endswith("/projects"):
+            projects = "\n".join(
+                f'<project uri="{url}/api/v2/projects/{id}" limsid="{id}"/>'
+                for id in self.modified
+            )
+            return Mock(content=projects_xml.format(projects=projects), status_code=200)
+        id = uri.split("/")[-1]
+        return Mock(
+            content=project_xml.format(url=url, id=id, name=self.names[id]),
+            status_code=200,
+        )
+
+    def test_sync(self):
+        store = MemoryStore()
+        sync = DeltaSync(self.lims, store, types=["projects"])
+        with patch("requests.Session.get", side_effect=self.get) as mocked_get:
+            result = sync.sync()
+            assert "last-modified" not in mocked_get.call_args_list[0][1]["params"]
+        assert [p.name for p in result["projects"]] == ["P1", "P2"]
+        mark = store.get_mark("projects")
+        assert mark is not None
+        assert (
+            ElementTree.fromstring(store.entities["projects"]["p2"]).find("name").text
+            == "P2"
+        )
+
+        self.modified = ["p2"]
+        self.names["p2"] = "P2 renamed"
+        with patch("requests.Session.get", side_effect=self.get) as mocked_get:
+            result = sync.sync()
+            assert mocked_get.call_args_list[0][1]["params"] == {"last-modified": mark}
+            assert mocked_get.call_count == 2
+        assert result["projects"] == [Project(self.lims, id="p2")]
+        assert Project(self.lims, id="p2").name == "P2 renamed"
+        assert b"P2 renamed" in store.entities["projects"]["p2"]
+        assert Project(self.lims, id="p1").name == "P1"
+
+    def test_failure_keeps_mark(self):
+        store = MemoryStore()
+        store.set_mark("projects", "2024-01-01T00:00:00.000Z")
+        self.names.pop("p2")
+        sync = DeltaSync(self.lims, store, types=["projects"])
+        with patch("requests.Session.get", side_effect=self.get):
+            result = sync.sync()
+        assert [p.id for p in result["projects"]] == ["p1"]
+        assert store.get_mark("projects") == "2024-01-01T00:00:00.000Z"
+
+    def test_reload(self):
+        cache = QueryCache(ttl=60)
+        lims = Lims(url, username="test", password="password", query_cache=cache)
+        samples_key = cache.key(Sample, dict(name="S1"))
+        cache.set(samples_key, [])
+        sync = DeltaSync(lims, MemoryStore(), types=["projects"])
+        with patch("requests.Session.get", side_effect=self.get):
+            sync.sync()
+            self.names["p1"] = "P1 renamed"
+            sync.sync()
+        # Loaded again rather than invalidated, and only the cached
+        # queries on projects are dropped
+        assert Project(lims, id="p1").root is not None
+        assert Project(lims, id="p1").name == "P1 renamed"
+        assert not lims.stale
+        assert cache.get(samples_key) == []
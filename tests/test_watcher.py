@@ -0,0 +1,144 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from genologics.entities import Container, Project
+from genologics.lims import Lims
+from genologics.watcher import CREATED, MODIFIED, UDF_CHANGED, ChangeWatcher
+
+url = "http://testgenologics.com:4040"
+
+projects_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<prj:projects xmlns:prj="http://genologics.com/ri/project">
+{projects}
+</prj:projects>"""
+
+project_xml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<prj:project xmlns:prj="http://genologics.com/ri/project" xmlns:udf="http://genologics.com/ri/userdefined" uri="{url}/api/v2/projects/{id}" limsid="{id}">
+<name>{name}</name>
+<udf:field type="String" name="Status">{status}</udf:field>
+</prj:project>"""
+
+
+class TestChangeWatcher(TestCase):
+    def setUp(self):
+        self.lims = Lims(url, username="test", password="password")
+        self.existing = ["p1"]
+        self.modified = []
+        self.projects = {"p1": ("P1", "open"), "p2": ("P2", "open")}
+        # LIMS id -> last-modified attribute of the list node, if any
+        self.times = dict()
+
+    def get(self, uri, params=None, **kwargs):
+        if uri.endswith("/projects"):
+            ids = self.modified if "last-modified" in params else self.existing
+            projects = "\n".join(
+                f'<project uri="{url}/api/v2/projects/{id}" limsid="{id}"'
+                + (f' last-modified="{self.times[id]}"/>' if id in self.times else "/>")
+                for id in ids
+            )
+            return Mock(content=projects_xml.format(projects=projects), status_code=200)
+        id = uri.split("/")[-1]
+        name, status = self.projects[id]
+        return Mock(
+            content=project_xml.format(url=url, id=id, name=name, status=status),
+            status_code=200,
+        )
+
+    def test_poll(self):
+        watcher = ChangeWatcher(
+            self.lims, types=["projects"], min_interval=1, max_interval=4
+        )
+        received = []
+        watcher.subscribe(received.append, name="projects", kind=UDF_CHANGED)
+        with patch("requests.Session.get", side_effect=self.get) as mocked_get:
+            assert watcher.poll() == []
+            # Baseline listing and the last-modified query, no entity loaded
+            assert mocked_get.call_count == 2
+            assert watcher.interval == 2
+
+            self.existing = self.modified = ["p1", "p2"]
+            events = watcher.poll()
+            assert [(e.kind, e.entity.id) for e in events] == [
+                (MODIFIED, "p1"),
+                (CREATED, "p2"),
+            ]
+            assert watcher.interval == 1
+
+            # Pulled again within the overlap, unchanged
+            assert watcher.poll() == []
+
+            self.projects["p1"] = ("P1", "closed")
+            events = watcher.poll()
+            assert [e.kind for e in events] == [MODIFIED, UDF_CHANGED]
+            assert events[1].changes == {"Status": ("open", "closed")}
+        assert received == [events[1]]
+
+    def test_without_baseline(self):
+        watcher = ChangeWatcher(self.lims, types=["projects"], baseline=False)
+        self.modified = ["p1"]
+        with patch("requests.Session.get", side_effect=self.get):
+            watcher.start()
+            assert [e.kind for e in watcher.poll()] == [CREATED]
+
+    def test_skip_unchanged(self):
+        watcher = ChangeWatcher(self.lims, types=["projects"])
+        self.existing = ["p1", "p2"]
+        self.modified = ["p1"]
+        self.times["p1"] = "2024-01-01T10:00:00.000Z"
+        with patch("requests.Session.get", side_effect=self.get) as mocked_get:
+            assert [e.kind for e in watcher.poll()] == [MODIFIED]
+            # Listed again with the same last-modified time, not loaded again
+            mocked_get.reset_mock()
+            assert watcher.poll() == []
+            assert mocked_get.call_count == 1
+
+            self.times["p1"] = "2024-01-01T10:05:00.000Z"
+            self.projects["p1"] = ("P1", "closed")
+            assert [e.kind for e in watcher.poll()] == [MODIFIED, UDF_CHANGED]
+        # Only the entities of events are kept in the identity map
+        assert list(self.lims.cache) == [Project(self.lims, id="p1").uri]
+
+    def test_max_entities(self):
+        watcher = ChangeWatcher(
+            self.lims, types=["projects"], baseline=False, max_entities=1
+        )
+        self.modified = ["p1", "p2"]
+        with patch("requests.Session.get", side_effect=self.get):
+            watcher.poll()
+        assert list(watcher.snapshots["projects"]) == ["p2"]
+
+    def test_cached_container(self):
+        container = Container(self.lims, id="c1")
+        state = {"name": "Plate", "time": "2024-01-01T10:00:00.000Z"}
+
+        def get(uri, params=None, **kwargs):
+            return Mock(
+                content=f"""<con:containers xmlns:con="http://genologics.com/ri/container">
+<container uri="{container.uri}" limsid="c1" last-modified="{state["time"]}"/>
+</con:containers>""",
+                status_code=200,
+            )
+
+        def post(uri, data=None, **kwargs):
+            return Mock(
+                content=f"""<con:details xmlns:con="http://genologics.com/ri/container">
+<con:container uri="{container.uri}" limsid="c1"><name>{state["name"]}</name></con:container>
+</con:details>""",
+                status_code=200,
+            )
+
+        with (
+            patch("requests.Session.get", side_effect=get),
+            patch("requests.Session.post", side_effect=post),
+        ):
+            # Listed and loaded by the script before the watcher starts
+            self.lims.get_containers()
+            self.lims.get_batch([container])
+            watcher = ChangeWatcher(self.lims, types=["containers"], baseline=False)
+            assert [e.kind for e in watcher.poll()] == [CREATED]
+
+            state.update(name="Plate renamed", time="2024-01-01T10:05:00.000Z")
+            events = watcher.poll()
+            assert [e.kind for e in events] == [MODIFIED]
+            assert events[0].entity is container
+        assert container.name == "Plate renamed"